@@ -0,0 +1,426 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
+from PIL import Image, ImageDraw
+import imagehash
+import pillow_heif
+from calculation import HashCalculator, DuplicateAnalyzer, load_image
+from hash_index import MultiIndexHash
+from hash_store import HashStore
+from memory_budget import MemoryBudget
+
+pillow_heif.register_heif_opener()
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak RSS is then reported as null
+    resource = None
+
+CORPUS_FORMATS = [("JPEG", ".jpg"), ("PNG", ".png"), ("BMP", ".bmp"), ("HEIF", ".heic")]
+CORPUS_SIZES = [(320, 240), (640, 480), (1920, 1080), (2592, 1944)]
+# Share of the corpus made of planted copies, and how those copies are made
+VARIANT_RATIO = 0.3
+VARIANT_KINDS = ("exact", "reencoded", "resized", "cropped")
+
+def synthetic_image(rng, width, height):
+
+    img = Image.new("RGB", (width, height), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(20):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = x0 + rng.randrange(width // 2), y0 + rng.randrange(height // 2)
+        draw.ellipse((x0, y0, x1, y1), fill=tuple(rng.randrange(256) for _ in range(3)))
+    # Seeded low-frequency noise gives the codecs real texture to work on
+    noise_size = (max(width // 8, 1), max(height // 8, 1))
+    noise = Image.frombytes("RGB", noise_size, rng.randbytes(noise_size[0] * noise_size[1] * 3))
+    return Image.blend(img, noise.resize((width, height), Image.BILINEAR), 0.2)
+
+def make_variant(rng, source, kind, image_path, file_format):
+
+    if kind == "exact":
+        shutil.copyfile(source, image_path)
+        return
+    with Image.open(source) as img:
+        img = img.convert("RGB")
+        width, height = img.size
+        if kind == "resized":
+            scale = rng.uniform(0.4, 0.9)
+            img = img.resize((max(int(width * scale), 1), max(int(height * scale), 1)), Image.LANCZOS)
+        elif kind == "cropped":
+            margin_x, margin_y = int(width * rng.uniform(0.02, 0.08)), int(height * rng.uniform(0.02, 0.08))
+            img = img.crop((margin_x, margin_y, width - margin_x, height - margin_y))
+        if file_format == "JPEG":
+            img.save(image_path, file_format, quality=rng.randrange(60, 90))
+        else:
+            img.save(image_path, file_format)
+
+def generate_corpus(folder_path, count, seed=0):
+
+    # Deterministic for a given (count, seed); returns one manifest entry per file written
+    rng = random.Random(seed)
+    original_count = max(count - int(count * VARIANT_RATIO), 1)
+    manifest = []
+    for i in range(count):
+        file_format, extension = CORPUS_FORMATS[i % len(CORPUS_FORMATS)]
+        image_path = os.path.join(folder_path, f"image_{i:05d}{extension}")
+        if i < original_count:
+            width, height = rng.choice(CORPUS_SIZES)
+            synthetic_image(rng, width, height).save(image_path, file_format)
+            manifest.append({"path": image_path, "format": file_format, "kind": "original", "source": None})
+            continue
+        source = manifest[rng.randrange(original_count)]
+        kind = rng.choice(VARIANT_KINDS)
+        if kind == "exact":
+            # Byte copies keep the source's format whatever the slot says
+            file_format = source["format"]
+            image_path = os.path.splitext(image_path)[0] + os.path.splitext(source["path"])[1]
+        make_variant(rng, source["path"], kind, image_path, file_format)
+        manifest.append({"path": image_path, "format": file_format, "kind": kind, "source": source["path"]})
+    return manifest
+
+def legacy_generate_hashes(image_path):
+
+    # The pre-change code path: one decode for pHash/dHash, one each for wHash and aHash
+    img = Image.open(image_path)
+    return image_path, {
+        "PHash": str(imagehash.phash(img)),
+        "DHash": str(imagehash.dhash(img)),
+        "WHash": str(imagehash.whash(Image.open(image_path))),
+        "AHash": str(imagehash.average_hash(Image.open(image_path)))
+    }
+
+def measure_throughput(generate_hashes, image_paths):
+
+    start = time.perf_counter()
+    for image_path in image_paths:
+        generate_hashes(image_path)
+    return len(image_paths) / (time.perf_counter() - start)
+
+def run_decode_benchmark(count, seed):
+
+    with tempfile.TemporaryDirectory() as folder_path:
+        image_paths = [entry["path"] for entry in generate_corpus(folder_path, count, seed)]
+        before = measure_throughput(legacy_generate_hashes, image_paths)
+        after = measure_throughput(HashCalculator()._generate_hashes, image_paths)
+    print(f"Corpus: {count} images ({', '.join(name for name, _ in CORPUS_FORMATS)})")
+    print(f"Before (one decode per hash): {before:.2f} images/second")
+    print(f"After (single shared decode): {after:.2f} images/second")
+    print(f"Speedup: {after / before:.2f}x")
+
+def generate_hashes(count, seed=0, near_duplicate_ratio=0.01, max_flips=8):
+
+    rng = np.random.default_rng(seed)
+    values = rng.integers(0, np.iinfo(np.uint64).max, count, dtype=np.uint64, endpoint=True)
+    planted = rng.choice(count, int(count * near_duplicate_ratio), replace=False)
+    for target in planted:
+        flips = rng.choice(64, rng.integers(0, max_flips + 1), replace=False)
+        values[target] = values[rng.integers(count)] ^ np.uint64(sum(1 << int(bit) for bit in flips))
+    return values
+
+def run_index_benchmark(sizes, radius, queries, seed, self_join_limit):
+
+    print(f"Multi-index hash, radius {radius}, {queries} queries per size")
+    for size in sizes:
+        values = generate_hashes(size, seed)
+        start = time.perf_counter()
+        index = MultiIndexHash(values)
+        build_time = time.perf_counter() - start
+
+        probes = values[np.random.default_rng(seed + 1).choice(size, queries)]
+        touched = 0
+        start = time.perf_counter()
+        for value in probes:
+            touched += len(index.candidates(value, radius))
+            index.query(value, radius)
+        query_ms = (time.perf_counter() - start) / queries * 1000
+
+        line = (f"{size:>9} hashes: build {build_time:.2f}s, query {query_ms:.3f} ms, "
+                f"touched {touched / queries / size:.4%} of corpus")
+        if size <= self_join_limit:
+            start = time.perf_counter()
+            pair_count = sum(len(i) for i, _, _ in index.pairs(radius))
+            line += f", all pairs {time.perf_counter() - start:.2f}s ({pair_count} pairs)"
+        print(line)
+
+def peak_rss_mb(who):
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def detection_rates(manifest, duplicate_groups, suspicious_groups):
+
+    # Share of planted copies that ended up in the same group as their source, per kind of copy
+    group_of = {}
+    for group_id, group in enumerate(duplicate_groups + suspicious_groups):
+        for image_path in group:
+            group_of[image_path] = group_id
+    rates = {}
+    for kind in VARIANT_KINDS:
+        variants = [entry for entry in manifest if entry["kind"] == kind]
+        if variants:
+            found = sum(1 for entry in variants
+                        if entry["path"] in group_of and group_of[entry["path"]] == group_of.get(entry["source"]))
+            rates[kind] = found / len(variants)
+    return rates
+
+def run_suite_size(size, seed, engine, workers):
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        corpus_path = os.path.join(work_dir, "corpus")
+        os.mkdir(corpus_path)
+        start = time.perf_counter()
+        manifest = generate_corpus(corpus_path, size, seed)
+        generation_s = time.perf_counter() - start
+
+        decode_times = {}
+        for entry in manifest:
+            start = time.perf_counter()
+            with load_image(entry["path"]):
+                pass
+            decode_times.setdefault(entry["format"], []).append(time.perf_counter() - start)
+
+        calculator = HashCalculator(engine=engine, max_workers=workers,
+                                    cache_file_path=os.path.join(work_dir, "image_hashes.cache"))
+        calculator.result_file_path = os.path.join(work_dir, "image_hashes.bin")
+        start = time.perf_counter()
+        calculator.calculate_hashes(corpus_path, lambda value, stats=None: None, lambda success: None)
+        hashing_s = time.perf_counter() - start
+
+        result = {}
+        analyzer = DuplicateAnalyzer(calculator.result_file_path)
+        start = time.perf_counter()
+        analyzer.find_duplicates(lambda duplicate_groups, suspicious_groups, hash_store: result.update(
+            duplicate_groups=duplicate_groups, suspicious_groups=suspicious_groups))
+        analysis_s = time.perf_counter() - start
+        # What a streaming reader waits for before it can show anything
+        start = time.perf_counter()
+        groups = analyzer.iter_groups()
+        next(groups, None)
+        first_group_s = time.perf_counter() - start
+        groups.close()
+
+    return {
+        "size": size,
+        "corpus_generation_s": generation_s,
+        "hashing_s": hashing_s,
+        "hashing_images_per_s": size / hashing_s,
+        "decode_ms_per_image": {file_format: sum(times) / len(times) * 1000 for file_format, times in decode_times.items()},
+        "analysis_s": analysis_s,
+        "first_group_s": first_group_s,
+        "duplicate_groups": len(result["duplicate_groups"]),
+        "suspicious_groups": len(result["suspicious_groups"]),
+        "detection_rate": detection_rates(manifest, result["duplicate_groups"], result["suspicious_groups"]),
+        "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+        "peak_rss_workers_mb": peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+    }
+
+def run_suite(sizes, seed, engine, workers, output_path):
+
+    # Each size runs in a fresh interpreter so peak RSS belongs to that size alone
+    results = []
+    for size in sizes:
+        command = [sys.executable, os.path.abspath(__file__), "suite-size", str(size), "--seed", str(seed),
+                   "--engine", engine]
+        if workers:
+            command += ["--workers", str(workers)]
+        completed = subprocess.run(command, capture_output=True, text=True, check=True)
+        results.append(json.loads(completed.stdout))
+        print(f"{size:>7} images: {results[-1]['hashing_images_per_s']:.1f} images/s hashing, "
+              f"{results[-1]['analysis_s']:.2f}s analysis, peak RSS {results[-1]['peak_rss_mb'] or 0:.0f} MB", file=sys.stderr)
+    report = {
+        "seed": seed,
+        "engine": engine,
+        "workers": workers or os.cpu_count(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+def read_store(store_path):
+
+    with HashStore(store_path) as store:
+        return {store.path(i): store.hashes(i) for i in range(len(store))}
+
+def run_shard_benchmark(count, shard_count, seed, workers):
+
+    # Stand-in nodes: one CLI process per shard, all running at once, then a local merge that
+    # must reproduce a single-node index exactly
+    cli_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cli.py")
+    with tempfile.TemporaryDirectory() as work_dir:
+        corpus_path = os.path.join(work_dir, "corpus")
+        os.mkdir(corpus_path)
+        generate_corpus(corpus_path, count, seed)
+        shard_paths = [os.path.join(work_dir, f"shard-{shard_id}.bin") for shard_id in range(shard_count)]
+        worker_args = ["--workers", str(workers)] if workers else []
+
+        start = time.perf_counter()
+        nodes = [subprocess.Popen([sys.executable, cli_path, "index", corpus_path, "--quiet",
+                                   "--shard-count", str(shard_count), "--shard-id", str(shard_id),
+                                   "--hashes", shard_path, "--cache", shard_path + ".cache"] + worker_args,
+                                  stdout=subprocess.DEVNULL)
+                 for shard_id, shard_path in enumerate(shard_paths)]
+        if any(node.wait() != 0 for node in nodes):
+            print("A shard failed", file=sys.stderr)
+            return 1
+        sharded_s = time.perf_counter() - start
+        merged_path = os.path.join(work_dir, "merged.bin")
+        start = time.perf_counter()
+        subprocess.run([sys.executable, cli_path, "merge", *shard_paths, "--root", corpus_path, "--hashes", merged_path],
+                       check=True, stdout=subprocess.DEVNULL)
+        merge_s = time.perf_counter() - start
+
+        single_path = os.path.join(work_dir, "single.bin")
+        start = time.perf_counter()
+        subprocess.run([sys.executable, cli_path, "index", corpus_path, "--quiet", "--hashes", single_path,
+                        "--cache", single_path + ".cache"] + worker_args, check=True, stdout=subprocess.DEVNULL)
+        single_s = time.perf_counter() - start
+
+        shard_sizes = [len(read_store(shard_path)) for shard_path in shard_paths]
+        identical = read_store(merged_path) == read_store(single_path)
+    print(f"{count} images, {shard_count} shards of {shard_sizes} images")
+    print(f"sharded {sharded_s:.2f}s + merge {merge_s:.2f}s, single node {single_s:.2f}s")
+    print(f"merged index matches single-node index: {'yes' if identical else 'NO'}")
+    return 0 if identical else 1
+
+# Modules that must stay out of a headless start; they are loaded lazily when needed
+LAZY_MODULES = ("tkinter", "PIL.ImageTk", "pillow_heif")
+
+def measure_import_time(module):
+
+    # Parses `python -X importtime` output: "import time: self [us] | cumulative | imported package"
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                               capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr)
+    imports = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append((name.strip(), int(self_us), int(cumulative_us)))
+    total_us = next(cumulative for name, _, cumulative in imports if name == module)
+    return total_us, imports
+
+def run_import_benchmark(modules, top, max_ms):
+
+    regressed = False
+    for module in modules:
+        total_us, imports = measure_import_time(module)
+        loaded = {name for name, _, _ in imports}
+        eager = [name for name in LAZY_MODULES if name in loaded]
+        print(f"{module}: {total_us / 1000:.1f} ms")
+        for name, self_us, _ in sorted(imports, key=lambda item: item[1], reverse=True)[:top]:
+            print(f"    {self_us / 1000:8.1f} ms  {name}")
+        if eager:
+            print(f"    imported eagerly: {', '.join(eager)}")
+            regressed = True
+        if max_ms is not None and total_us / 1000 > max_ms:
+            print(f"    over the {max_ms} ms budget")
+            regressed = True
+    return 1 if regressed else 0
+
+_check_budget = None
+
+def init_budget_worker(memory_budget):
+
+    global _check_budget
+    _check_budget = memory_budget
+
+def hold_reservation(amount, seconds):
+
+    with _check_budget.reserve(amount):
+        start = time.monotonic()
+        time.sleep(seconds)
+        return os.getpid(), start, time.monotonic()
+
+def run_budget_check(workers, hold):
+
+    # Every reservation takes 60% of one shared budget, so no two may be held at the same time,
+    # whichever worker processes they come from
+    limit = 100 * 1024 * 1024
+    budget = MemoryBudget.shared(limit)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_budget_worker, initargs=(budget,)) as executor:
+        spans = sorted(executor.map(hold_reservation, repeat(limit * 6 // 10, workers), repeat(hold, workers)),
+                       key=lambda span: span[1])
+    overlaps = sum(1 for (_, _, end), (_, start, _) in zip(spans, spans[1:]) if start < end)
+    processes = len({pid for pid, _, _ in spans})
+    print(f"{len(spans)} reservations from {processes} processes, {overlaps} held at the same time")
+    return 1 if overlaps or processes < 2 else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Image plagiarism check benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    decode_parser = subparsers.add_parser("decode", help="Hashing throughput before and after the single-decode path")
+    decode_parser.add_argument("--count", type=int, default=60)
+    decode_parser.add_argument("--seed", type=int, default=0)
+
+    index_parser = subparsers.add_parser("index", help="Near-duplicate index scaling")
+    index_parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    index_parser.add_argument("--radius", type=int, default=6)
+    index_parser.add_argument("--queries", type=int, default=200)
+    index_parser.add_argument("--seed", type=int, default=0)
+    index_parser.add_argument("--self-join-limit", type=int, default=100_000,
+                              help="Largest size for which the all-pairs search is also timed")
+
+    import_parser = subparsers.add_parser("importtime", help="Startup cost of the headless modules")
+    import_parser.add_argument("--modules", nargs="+", default=["calculation", "cli"])
+    import_parser.add_argument("--top", type=int, default=10, help="Slowest imports to list per module")
+    import_parser.add_argument("--max-ms", type=float, default=None,
+                               help="Fail when a module takes longer than this to import")
+
+    shard_parser = subparsers.add_parser("shards", help="Sharded indexing with one process per shard, then merge")
+    shard_parser.add_argument("--count", type=int, default=200)
+    shard_parser.add_argument("--shards", type=int, default=4)
+    shard_parser.add_argument("--seed", type=int, default=0)
+    shard_parser.add_argument("--workers", type=int, default=None, help="Workers per shard process")
+
+    budget_parser = subparsers.add_parser("budget", help="Check that worker processes share one memory budget")
+    budget_parser.add_argument("--workers", type=int, default=4)
+    budget_parser.add_argument("--hold", type=float, default=0.5, help="Seconds each reservation is held")
+
+    suite_parser = subparsers.add_parser("suite", help="Full benchmark over synthetic corpora of several sizes")
+    suite_parser.add_argument("--sizes", type=int, nargs="+", default=[100, 400, 1600])
+    suite_parser.add_argument("--output", help="JSON report path (default: stdout)")
+    size_parser = subparsers.add_parser("suite-size", help="One suite measurement; used internally by 'suite'")
+    size_parser.add_argument("size", type=int)
+    for subparser in (suite_parser, size_parser):
+        subparser.add_argument("--seed", type=int, default=0)
+        subparser.add_argument("--engine", choices=HashCalculator.ENGINES, default="process")
+        subparser.add_argument("--workers", type=int, default=None)
+
+    args = parser.parse_args()
+    if args.command == "suite":
+        run_suite(args.sizes, args.seed, args.engine, args.workers, args.output)
+    elif args.command == "suite-size":
+        json.dump(run_suite_size(args.size, args.seed, args.engine, args.workers), sys.stdout)
+    elif args.command == "decode":
+        run_decode_benchmark(args.count, args.seed)
+    elif args.command == "index":
+        run_index_benchmark(args.sizes, args.radius, args.queries, args.seed, args.self_join_limit)
+    elif args.command == "shards":
+        sys.exit(run_shard_benchmark(args.count, args.shards, args.seed, args.workers))
+    elif args.command == "budget":
+        sys.exit(run_budget_check(args.workers, args.hold))
+    else:
+        sys.exit(run_import_benchmark(args.modules, args.top, args.max_ms))
@@ -1,162 +1,873 @@
+import heapq
 import os
-from PIL import Image
+import signal
+import sys
+import threading
+import time
+import warnings
+from contextlib import nullcontext
+import numpy as np
+from PIL import Image, UnidentifiedImageError
 import imagehash
-from concurrent.futures import ThreadPoolExecutor
-import pillow_heif
-
-pillow_heif.register_heif_opener()
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from file_digest import IdenticalFiles
+from hash_cache import HashCache, file_signature
+from hash_store import HASH_TYPES, HashStore, HashStoreWriter, open_hash_writer, import_text_hashes
+from hash_index import MultiIndexHash, UnionFind, all_pairs, popcount64, rows_against_all, tier_matches
+from memory_budget import MemoryBudget, decoded_size, pin_mmap_threshold
+from metrics import PipelineMetrics, StageTimer
+from reference import ReferenceIndex
+from scanner import scan_images
+from shards import relative_image_path, shard_metadata, shard_of
+
+LEGACY_RESULT_FILE_PATH = "image_hashes.txt"
+HASH_FUNCTIONS = {
+    "PHash": imagehash.phash,
+    "DHash": imagehash.dhash,
+    "WHash": imagehash.whash,
+    "AHash": imagehash.average_hash,
+}
+# Largest Hamming distance (out of 64 bits) at which two hashes of a type still count as matching
+DEFAULT_THRESHOLDS = {"PHash": 6, "DHash": 6, "WHash": 4, "AHash": 4}
+# Smallest size images are decoded/reduced to; comfortably above the 32x32 pHash input
+HASH_DECODE_SIZE = (256, 256)
+# Major brands of the ISO-BMFF "ftyp" box that mark a HEIF image, whatever the box size
+HEIF_BRANDS = (b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"hevm", b"hevs", b"mif1", b"msf1")
+SNIFF_SIZE = 12
+# Default cap on memory used by concurrent decodes, and the largest image opened at all
+DEFAULT_MEMORY_BUDGET = 1 << 30
+MAX_IMAGE_PIXELS = 1 << 30
+
+def sniff_file_type(header):
+
+    if header[4:8] == b"ftyp" and header[8:12] in HEIF_BRANDS:  # HEIF
+        return "HEIF"
+    elif header.startswith(b"\xff\xd8\xff"):  # JPEG
+        return "JPEG"
+    elif header.startswith(b"\x89PNG\r\n\x1a\n"):  # PNG
+        return "PNG"
+    elif header.startswith(b"GIF87a") or header.startswith(b"GIF89a"):  # GIF
+        return "GIF"
+    elif header.startswith(b"BM"):  # BMP
+        return "BMP"
+    else:
+        return "Unknown"
 
 def get_file_type(image_path):
 
     with open(image_path, "rb") as f:
-        header = f.read(12)
-        if header.hex().startswith("0000001c667479706865"):  # HEIF
-            return "HEIF"
-        elif header.startswith(b"\xff\xd8\xff"):  # JPEG
-            return "JPEG"
-        elif header.startswith(b"\x89PNG\r\n\x1a\n"):  # PNG
-            return "PNG"
-        elif header.startswith(b"GIF87a") or header.startswith(b"GIF89a"):  # GIF
-            return "GIF"
-        else:
-            return "Unknown"
+        return sniff_file_type(f.read(SNIFF_SIZE))
+
+_heif_registered = False
+_memory_budget = None
+
+def set_memory_budget(memory_budget, max_image_pixels=MAX_IMAGE_PIXELS):
+
+    # Installed once per worker process (or once for a thread pool) before any image is decoded
+    global _memory_budget
+    _memory_budget = memory_budget
+    pin_mmap_threshold()
+    # The budget now guards memory, so Pillow's fixed decompression-bomb limit moves up to ours
+    Image.MAX_IMAGE_PIXELS = max_image_pixels
+    warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+
+def init_process_worker(memory_budget):
+
+    # Ctrl-C is the parent's to handle: it cancels the run and lets the workers finish their batches
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    set_memory_budget(memory_budget)
 
-def calculate_hashes(image_path):
+def register_heif_codec():
 
+    # pillow_heif is only loaded once a HEIC/HEIF file actually turns up, once per process
+    global _heif_registered
+    if not _heif_registered:
+        import pillow_heif
+        pillow_heif.register_heif_opener()
+        _heif_registered = True
+
+def open_image(image_path):
+
+    # Accepts a path or an open binary file; Image.open rewinds files itself
     try:
-        img = Image.open(image_path)
-        p_hash = imagehash.phash(img)
-        d_hash = imagehash.dhash(img)
-        return p_hash, d_hash
+        return Image.open(image_path)
+    except UnidentifiedImageError:
+        if _heif_registered:
+            raise
+        # HEIF brands the header sniff does not know about still get a chance
+        register_heif_codec()
+        return Image.open(image_path)
+
+def load_image(image_path, image_file=None):
+
+    img = open_image(image_file or image_path)
+    memory_budget = _memory_budget
+    if img.format == "JPEG" or memory_budget is not None and memory_budget.oversized(decoded_size(img)):
+        # Let libjpeg scale down by 1/2, 1/4 or 1/8 while decoding; for oversized HEIF files
+        # this picks an embedded thumbnail instead. Other formats ignore it.
+        img.draft("L", HASH_DECODE_SIZE)
+    # Nothing is decoded before convert(), so the reservation covers the whole peak
+    with memory_budget.reserve(decoded_size(img)) if memory_budget is not None else nullcontext():
+        img = img.convert("L")
+        # Box-reduce what the decoder could not, so every hash works from the same small image
+        factor = min(img.size[0] // HASH_DECODE_SIZE[0], img.size[1] // HASH_DECODE_SIZE[1])
+        if factor > 1:
+            img = img.reduce(factor)
+    return img
+
+def load_thumbnail(image_path, size):
+
+    # Same reduced-resolution decode as load_image, but in colour and at thumbnail scale
+    with open_image(image_path) as img:
+        if img.format == "JPEG":
+            img.draft("RGB", size)
+        img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+    img.thumbnail(size)
+    return img
+
+def calculate_hashes(image_path, timer=None, image_file=None, hash_types=HASH_TYPES):
+
+    timer = timer or StageTimer()
+    try:
+        with timer.stage("decode"):
+            img = load_image(image_path, image_file)
+        with img:
+            hashes = {}
+            for hash_type in hash_types:
+                with timer.stage(hash_type):
+                    hashes[hash_type] = str(HASH_FUNCTIONS[hash_type](img))
+            return hashes
     except Exception as e:
-        print(f"Error processing {image_path}: {e}")
+        timer.count("too_large" if isinstance(e, Image.DecompressionBombError) else "failed")
+        print(f"Error processing {image_path}: {e}", file=sys.stderr)
 
         try:
             file_size = os.path.getsize(image_path)
-            print(f"File size: {file_size} bytes")
+            print(f"File size: {file_size} bytes", file=sys.stderr)
             with open(image_path, 'rb') as f:
                 file_header = f.read(10).hex()
-                print(f"File header: {file_header}")
+                print(f"File header: {file_header}", file=sys.stderr)
         except Exception as inner_e:
-            print(f"Error getting file info: {inner_e}")
-        return None, None
+            print(f"Error getting file info: {inner_e}", file=sys.stderr)
+        return None
 
-class HashCalculator:
-    result_file_path = "image_hashes.txt"
+def generate_hashes(image_path, timer=None, hash_types=HASH_TYPES):
 
-    def __init__(self):
-        pass
+    timer = timer or StageTimer()
+    try:
+        image_file = open(image_path, "rb")
+    except OSError as e:
+        print(f"Error processing {image_path}: {e}", file=sys.stderr)
+        timer.count("failed")
+        return None
+    with image_file:
+        # peek() fills the read buffer the decoder then starts from, so the sniff costs no extra read
+        with timer.stage("sniff"):
+            file_type = sniff_file_type(image_file.peek(SNIFF_SIZE)[:SNIFF_SIZE])
+        if file_type == "Unknown":
+            print(f"Skipping unrecognized file: {image_path}", file=sys.stderr)
+            timer.count("skipped")
+            return None
+        if file_type == "HEIF":
+            register_heif_codec()
+        hashes = calculate_hashes(image_path, timer, image_file, hash_types)
+    if hashes is None:
+        return None
+    timer.count(f"hashed_{file_type}")
+    return image_path, hashes
+
+def generate_hashes_batch(image_paths, hash_types=HASH_TYPES):
+
+    # Stage timings travel back with the results so process workers can be measured too
+    timer = StageTimer()
+    return [generate_hashes(image_path, timer, hash_types) for image_path in image_paths], timer.as_dict()
+
+class HashingCancelled(Exception):
+    pass
+
+# State of one HashCalculator.calculate_hashes call. Files stream in from the scanner and are
+# resolved from the cache or from a byte-identical copy where possible; the rest wait in a
+# heap so that, of the files found so far, the largest are handed to the workers first.
+class HashingRun:
+    def __init__(self, calculator, folder_path, executor, writer, metrics, digest_executor=None):
+
+        self.calculator = calculator
+        self.folder_path = folder_path
+        self.executor = self.initial_executor = executor
+        self.writer = writer
+        self.metrics = metrics
+        # Only the first tier is hashed here; later tiers are added for candidates afterwards
+        self.hash_types = calculator.hash_tiers[0]
+        self.on_result = self.record
+        self.signatures = {}
+        self.stats = {"cache_hits": 0, "cache_misses": 0, "identical_copies": 0, "cascade_hashed": 0}
+        self.identical_files = IdenticalFiles(digest_executor)
+        self.waiting = []
+        self.followers = {}
+        # future -> (batch, executor it was submitted to)
+        self.pending = {}
+        # Files of batches lost with a crashed worker process, retried one at a time
+        self.retry = []
+        self.retried = set()
+        self.processed = 0
+        self.last_checkpoint = time.monotonic()
+
+    def add(self, entries):
+
+        # One scanned directory at a time, so the digests the copy check needs are read together
+        cache = self.calculator.cache
+        new_files = []
+        for image_path, stat_result in entries:
+            self.signatures[image_path] = file_signature(stat_result, cache.use_inode)
+            hit, hashes = self.lookup(image_path)
+            if hit:
+                self.stats["cache_hits"] += 1
+                self.identical_files.add_known(image_path, stat_result.st_size)
+                self.record(image_path, hashes)
+                continue
+            self.stats["cache_misses"] += 1
+            new_files.append((image_path, stat_result.st_size))
+        with self.metrics.stage("digest"):
+            originals = self.identical_files.add_many(new_files)
+        for (image_path, size), original in zip(new_files, originals):
+            if original is not None:
+                # A byte-identical copy of a file seen earlier takes its hashes instead of being decoded
+                self.stats["identical_copies"] += 1
+                done, hashes = self.lookup(original)
+                if done:
+                    self.record(image_path, hashes)
+                else:
+                    self.followers.setdefault(original, []).append(image_path)
+                continue
+            heapq.heappush(self.waiting, (-size, image_path))
+            self.metrics.total += 1
+
+    def lookup(self, image_path):
+
+        hit, hashes = self.calculator.cache.lookup(image_path, self.signatures[image_path])
+        # Entries from a run with other hash types only count if they cover this run's types
+        if hit and hashes is not None and not all(hash_type in hashes for hash_type in self.hash_types):
+            return False, None
+        return hit, hashes
+
+    def record(self, image_path, hashes):
+
+        self.calculator.cache.update(image_path, self.signatures[image_path], hashes)
+        if hashes is not None:
+            self.writer.write(self.calculator.stored_path(image_path, self.folder_path), hashes)
+        self.processed += 1
+
+    def submit(self, final=False):
+
+        # Partial batches only go out once the scan has finished; nothing goes out after a cancel
+        chunk_size = self.calculator.chunk_size
+        if self.retry:
+            # Alone in flight, so a file that crashes the worker again is known to be the cause
+            if not self.pending and not self.calculator.cancelled():
+                batch = [self.retry.pop()]
+                self.pending[self.executor.submit(generate_hashes_batch, batch, self.hash_types)] = batch, self.executor
+            return
+        while not self.calculator.cancelled() and len(self.pending) < self.calculator.max_in_flight and self.waiting and (
+                final or len(self.waiting) >= chunk_size):
+            batch = [heapq.heappop(self.waiting)[1] for _ in range(min(chunk_size, len(self.waiting)))]
+            self.pending[self.executor.submit(generate_hashes_batch, batch, self.hash_types)] = batch, self.executor
+
+    def collect(self, timeout=None):
+
+        # Results are written as soon as any batch finishes, so one slow file holds up only its own batch
+        done, _ = wait(self.pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            batch, executor = self.pending.pop(future)
+            try:
+                results, batch_timings = future.result()
+            except BrokenProcessPool:
+                results = self.worker_crashed(batch, executor)
+                if results is None:
+                    continue
+            else:
+                self.metrics.timer.merge(batch_timings)
+            with self.metrics.stage("write"):
+                for image_path, result in zip(batch, results):
+                    hashes = result[1] if result else None
+                    # Byte-identical copies share the hashes of the one file that was decoded
+                    for copy_path in [image_path] + self.followers.pop(image_path, []):
+                        self.on_result(copy_path, hashes)
+            self.metrics.advance(len(batch))
+        if time.monotonic() - self.last_checkpoint >= self.calculator.checkpoint_interval:
+            with self.metrics.stage("checkpoint"):
+                self.calculator.cache.checkpoint()
+            self.last_checkpoint = time.monotonic()
+
+    def worker_crashed(self, batch, executor):
+
+        # A worker process died, e.g. killed by the OS for its memory, and took every batch of its
+        # pool with it. The pool is replaced once and the lost files are retried one by one; a file
+        # that brings a worker down on its own is recorded as failed.
+        if executor is self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = self.calculator.create_executor()
+            self.metrics.timer.count("worker_restarts")
+        if len(batch) > 1 or batch[0] not in self.retried:
+            self.retried.update(batch)
+            self.retry.extend(reversed(batch))
+            return None
+        print(f"Error processing {batch[0]}: the hashing worker crashed", file=sys.stderr)
+        self.metrics.timer.count("failed")
+        return [None]
+
+    def close(self):
+
+        # A pool that replaced a crashed one is not covered by the caller's with statement
+        if self.executor is not self.initial_executor:
+            self.executor.shutdown()
+
+    def begin_tier(self, hash_types, image_paths, on_result):
+
+        # Queues a later tier for the given files; its results go to on_result instead of the writer
+        self.hash_types = hash_types
+        self.on_result = on_result
+        for image_path in image_paths:
+            heapq.heappush(self.waiting, (-self.signatures[image_path][0], image_path))
+        self.metrics.total += len(image_paths)
+
+    def unfinished(self):
+
+        # After a cancel only the batches already handed to the workers are still waited for
+        return bool(self.pending or (self.waiting or self.retry) and not self.calculator.cancelled())
+
+    def report(self, progress_callback):
+
+        total_files = len(self.signatures)
+        progress_callback(self.processed / total_files * 100 if total_files else 100, self.stats)
+        self.metrics.report()
+
+class HashCalculator:
+    result_file_path = "image_hashes.bin"
+    ENGINES = ("process", "thread")
+
+    def __init__(self, engine="process", max_workers=None, chunk_size=16, max_in_flight=None,
+                 cache_file_path="image_hashes.cache", use_inode=False, metrics_callback=None,
+                 metrics_path=None, profile=False, identical_callback=None, shard_count=1, shard_id=0,
+                 root_id=None, memory_budget=DEFAULT_MEMORY_BUDGET, hash_tiers=None, thresholds=None,
+                 checkpoint_interval=30):
+
+        if engine not in self.ENGINES:
+            raise ValueError(f"Unknown hashing engine: {engine}")
+        if not 0 <= shard_id < shard_count:
+            raise ValueError(f"Shard id {shard_id} is outside 0..{shard_count - 1}")
+        # Hash types in the order they are computed. Every image gets the first tier; each later
+        # tier is only computed for images the tiers before it put in a candidate group.
+        self.hash_tiers = tuple(tuple(tier) for tier in hash_tiers or (HASH_TYPES,))
+        self.hash_types = tuple(hash_type for tier in self.hash_tiers for hash_type in tier)
+        if (not all(self.hash_tiers) or len(set(self.hash_types)) != len(self.hash_types)
+                or not set(self.hash_types) <= set(HASH_FUNCTIONS)):
+            raise ValueError(f"Invalid hash tiers: {self.hash_tiers}")
+        if len(self.hash_tiers) > 1 and shard_count > 1:
+            raise ValueError("Cascaded hashing needs the whole folder and cannot be combined with sharding")
+        # Distances at which earlier tiers make two images candidates for the later ones
+        self.thresholds = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+        # Seconds between fsyncs of the cache journal; a crash loses at most this much work
+        self.checkpoint_interval = checkpoint_interval
+        self.cancel_event = threading.Event()
+        self.engine = engine
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        # Number of batches queued or running at once; bounds the futures held in memory
+        self.max_in_flight = max_in_flight or self.max_workers * 2
+        self.cache = HashCache(cache_file_path, use_inode)
+        # Per-stage timings, counters and throughput; metrics_path also receives a JSON summary
+        self.metrics_callback = metrics_callback
+        self.metrics_path = metrics_path
+        self.profile = profile
+        self.metrics = None
+        # Called with the groups of byte-identical files as soon as the pre-pass has found them
+        self.identical_callback = identical_callback
+        # With several shards each node hashes its own slice of the folder and writes relative paths
+        self.shard_count = shard_count
+        self.shard_id = shard_id
+        self.root_id = root_id
+        # Bytes of decoded pixels all workers together may hold at once
+        self.memory_budget = memory_budget
 
     def has_existing_hashes(self):
 
-        return os.path.exists(self.result_file_path)
+        return os.path.exists(self.result_file_path) or os.path.exists(LEGACY_RESULT_FILE_PATH)
 
     def calculate_hashes(self, folder_path, progress_callback, completion_callback):
 
-        image_paths = self._find_images(folder_path)
-        total_files = len(image_paths)
-
-        with ThreadPoolExecutor() as executor:
-            futures = [executor.submit(self._generate_hashes, path) for path in image_paths]
-            with open(self.result_file_path, 'w', encoding='utf-8') as result_file:
-                for i, future in enumerate(futures, start=1):
-                    result = future.result()
-                    if result:
-                        image_path, hashes = result
-                        output = self._format_hash_output(image_path, hashes)
-                        result_file.write(output)
-                    progress_callback(i / total_files * 100)
+        self.cancel_event.clear()
+        metrics = self.metrics = PipelineMetrics("hashing", self.metrics_callback, self.metrics_path, self.profile)
+        metrics.start()
+        with metrics.stage("cache_load"):
+            self.cache.load()
+        # Every image hashed from here on is journaled, so a crash or cancel can be resumed
+        self.cache.start_journal({"folder": folder_path, "hashes": self.result_file_path})
+        metadata = {"hash_tiers": [list(tier) for tier in self.hash_tiers]}
+        if len(self.hash_tiers) > 1:
+            metadata["candidate_thresholds"] = {hash_type: self.thresholds[hash_type]
+                                                for tier in self.hash_tiers[:-1] for hash_type in tier}
+        if self.shard_count > 1:
+            metadata.update(shard_metadata(self.root_id or os.path.basename(os.path.abspath(folder_path)),
+                                           self.shard_id, self.shard_count))
+
+        # With later tiers the first pass goes to a file of its own, and replaces the previous hash
+        # file only once every tier has been added
+        store_path = self.result_file_path + ".partial" if len(self.hash_tiers) > 1 else self.result_file_path
+        run = None
+        try:
+            # File digests are I/O, so they get threads of their own next to the hashing workers
+            with self.create_executor() as executor, ThreadPoolExecutor(max_workers=self.max_workers) as digest_executor:
+                with open_hash_writer(store_path, self.hash_types, metadata) as writer:
+                    run = HashingRun(self, folder_path, executor, writer, metrics, digest_executor)
+                    # Workers start on the first directories while the rest of the tree is still being listed
+                    scanner = scan_images(folder_path)
+                    while not self.cancelled():
+                        with metrics.stage("walk"):
+                            entries = next(scanner, None)
+                        if entries is None:
+                            break
+                        run.add([(image_path, stat_result) for image_path, stat_result in entries
+                                 if self.in_shard(image_path, folder_path)])
+                        run.submit()
+                        run.collect(timeout=0)
+                        run.report(progress_callback)
+                    if self.identical_callback is not None and run.identical_files.copies:
+                        self.identical_callback(run.identical_files.groups())
+                    while run.unfinished():
+                        run.submit(final=True)
+                        run.collect()
+                        run.report(progress_callback)
+                    if self.cancelled():
+                        # The previous hash file stays in place; the journal holds what was finished
+                        raise HashingCancelled()
+                    run.report(progress_callback)
+                for level in range(1, len(self.hash_tiers)):
+                    self._hash_candidates(run, level, store_path, progress_callback)
+            if store_path != self.result_file_path:
+                os.replace(store_path, self.result_file_path)
+        except HashingCancelled:
+            for name, amount in run.stats.items():
+                metrics.timer.count(name, amount)
+            metrics.timer.count("cancelled")
+            metrics.finish()
+            completion_callback(False)
+            return
+        except Exception:
+            # The run failed, e.g. the hash file could not be written; the caller still hears it ended
+            metrics.finish()
+            completion_callback(False)
+            raise
+        finally:
+            if run is not None:
+                run.close()
+            self.cache.close_journal()
+            if store_path != self.result_file_path and os.path.exists(store_path):
+                os.remove(store_path)
+
+        self.cache.prune(folder_path, run.signatures, lambda image_path: self.in_shard(image_path, folder_path))
+        for name, amount in run.stats.items():
+            metrics.timer.count(name, amount)
+        with metrics.stage("cache_save"):
+            self.cache.save()
+        metrics.finish()
         completion_callback(True)
 
-    def _find_images(self, folder_path):
+    def cancel(self):
 
-        return [os.path.join(root, file)
-                for root, _, files in os.walk(folder_path)
-                for file in files
-                if file.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.heic'))]
+        # Stops handing out work; batches already with the workers are finished and journaled
+        self.cancel_event.set()
 
-    def _generate_hashes(self, image_path):
+    def cancelled(self):
 
-        file_type = get_file_type(image_path)
-        if file_type == "Unknown":
-            print(f"Skipping unrecognized file: {image_path}")
-            return None
-        p_hash, d_hash = calculate_hashes(image_path)
-        if p_hash is None or d_hash is None:
-            return None
-        hashes = {
-            "PHash": str(p_hash),
-            "DHash": str(d_hash),
-            "WHash": str(imagehash.whash(Image.open(image_path))),
-            "AHash": str(imagehash.average_hash(Image.open(image_path)))
-        }
-        return image_path, hashes
+        return self.cancel_event.is_set()
 
-    def _format_hash_output(self, image_path, hashes):
+    def interrupted_folder(self):
 
-        return f"Image: {image_path}\n" + "\n".join(
-            f"{k}: {v}" for k, v in hashes.items()
-        ) + "\n\n"
+        # Folder of a run that was cancelled or crashed before it finished, if any
+        run_info = self.cache.interrupted_run()
+        return run_info["folder"] if run_info else None
 
-class DuplicateAnalyzer:
-    def __init__(self):
-        pass
+    def resume(self, progress_callback, completion_callback):
 
-    def find_duplicates(self, completion_callback):
+        # A rerun of the interrupted folder; every image finished before the interruption is a cache hit
+        self.calculate_hashes(self.interrupted_folder(), progress_callback, completion_callback)
 
-        all_image_hashes = self._parse_hash_file()
-        duplicate_groups, suspicious_groups = self._find_duplicates_and_suspicious(all_image_hashes)
-        completion_callback(duplicate_groups, suspicious_groups, all_image_hashes)
+    def in_shard(self, image_path, folder_path):
 
-    def _parse_hash_file(self):
+        return self.shard_count == 1 or shard_of(relative_image_path(image_path, folder_path), self.shard_count) == self.shard_id
 
-        all_image_hashes = {}
-        current_image = ""
-        with open("image_hashes.txt", 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith("Image: "):
-                    current_image = line[7:]
-                    all_image_hashes[current_image] = {}
-                elif line:
-                    hash_type, hash_value = line.split(": ")
-                    all_image_hashes[current_image][hash_type] = hash_value
-        return all_image_hashes
+    def stored_path(self, image_path, folder_path):
 
-    def _find_duplicates_and_suspicious(self, all_image_hashes):
+        return relative_image_path(image_path, folder_path) if self.shard_count > 1 else image_path
 
-        duplicate_groups = []
-        suspicious_groups = []
-        image_paths = list(all_image_hashes.keys())
-        grouped_images = set()
+    def _hash_candidates(self, run, level, store_path, progress_callback):
 
-        for i in range(len(image_paths)):
-            if image_paths[i] in grouped_images:
-                continue
-            duplicate_group = [image_paths[i]]
-            suspicious_group = []
+        # Adds tier `level` to the store at store_path, for the images the earlier tiers grouped
+        hash_types = self.hash_tiers[level]
+        metrics = run.metrics
+        store = HashStore(store_path)
+        next_path = store_path + ".next"
+        try:
+            with metrics.stage("candidates"):
+                candidates = DuplicateAnalyzer().candidates(store, level)
+            # Byte-identical copies take the hashes of their original instead of being decoded again
+            original_of = {copy: original for original, copies in run.identical_files.copies.items() for copy in copies}
+            columns = [store.hash_types.index(hash_type) for hash_type in hash_types]
+            missing = candidates[~store.presence(candidates)[:, columns].all(axis=1)]
+            todo = sorted({original_of.get(store.path(i), store.path(i)) for i in missing.tolist()})
+            computed = {}
+            first_hashed = run.stats["cascade_hashed"]
+
+            def add_tier(image_path, result):
+
+                run.stats["cascade_hashed"] += 1
+                if not result:
+                    return
+                computed[image_path] = result
+                # Journaled as the batch arrives, so a resumed run does not hash this tier again
+                for copy_path in [image_path] + run.identical_files.copies.get(image_path, []):
+                    _, hashes = self.cache.lookup(copy_path, run.signatures[copy_path])
+                    self.cache.update(copy_path, run.signatures[copy_path], dict(hashes or {}, **result))
+
+            # Same bounded window of batches as the first pass, so a cancel stops handing out work
+            run.begin_tier(hash_types, todo, add_tier)
+            while run.unfinished():
+                run.submit(final=True)
+                run.collect()
+                progress_callback((run.stats["cascade_hashed"] - first_hashed) / len(todo) * 100, run.stats)
+                metrics.report()
+            if self.cancelled():
+                raise HashingCancelled()
+            with metrics.stage("write"), HashStoreWriter(next_path, store.hash_types, store.metadata) as writer:
+                for i in range(len(store)):
+                    image_path = store.path(i)
+                    hashes = store.hashes(i)
+                    added = computed.get(original_of.get(image_path, image_path))
+                    if added:
+                        hashes.update(added)
+                    writer.write(image_path, hashes)
+        finally:
+            store.close()
+        os.replace(next_path, store_path)
+
+    def create_executor(self):
+
+        if self.engine == "process":
+            return ProcessPoolExecutor(max_workers=self.max_workers, initializer=init_process_worker,
+                                       initargs=(MemoryBudget.shared(self.memory_budget),))
+        set_memory_budget(MemoryBudget(self.memory_budget))
+        return ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def _generate_hashes(self, image_path):
+
+        return generate_hashes(image_path)
+
+class DuplicateAnalyzer:
+    METHODS = ("index", "exhaustive")
+
+    def __init__(self, hash_file_path=HashCalculator.result_file_path, thresholds=None, method="index",
+                 max_workers=None, metrics_callback=None, metrics_path=None, profile=False):
+
+        if method not in self.METHODS:
+            raise ValueError(f"Unknown analysis method: {method}")
+        self.hash_file_path = hash_file_path
+        self.thresholds = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+        # Kept apart from the defaults: only these may tighten a cascaded store's candidate distances
+        self.requested_thresholds = dict(thresholds or {})
+        # "exhaustive" compares every pair for audits; "index" only visits likely matches
+        self.method = method
+        self.max_workers = max_workers
+        self.reference_index = None
+        self.metrics_callback = metrics_callback
+        self.metrics_path = metrics_path
+        self.profile = profile
+        self.metrics = None
 
-            for j in range(i + 1, len(image_paths)):
-                if image_paths[j] in grouped_images:
+    def find_duplicates(self, completion_callback):
+
+        metrics = self.metrics = PipelineMetrics("analysis", self.metrics_callback, self.metrics_path, self.profile)
+        metrics.start()
+        with metrics.stage("parse"):
+            hash_store = self._load_hash_store()
+        metrics.total = len(hash_store)
+        duplicate_groups, suspicious_groups = self._find_duplicates_and_suspicious(hash_store)
+        metrics.advance(len(hash_store))
+        metrics.timer.count("duplicate_groups", len(duplicate_groups))
+        metrics.timer.count("suspicious_groups", len(suspicious_groups))
+        metrics.finish()
+        completion_callback(duplicate_groups, suspicious_groups, hash_store)
+
+    def iter_groups(self, progress_callback=None, include_hashes=False, block_size=1024):
+
+        # Yields {"type": "duplicate" | "suspicious", "images": [...]} for each group as soon as it is
+        # final, ordered by first member like find_duplicates. Groups grow breadth-first from a block
+        # of seeds through range queries on the first tier, and a group is final once every member has
+        # been expanded, so only the groups still growing are held in memory.
+        metrics = self.metrics = PipelineMetrics("analysis", self.metrics_callback, self.metrics_path, self.profile)
+        metrics.start()
+        with metrics.stage("parse"):
+            hash_store = self._load_hash_store()
+        tile_executor = None
+        try:
+            with metrics.stage("parse"):
+                matrix = hash_store.matrix()
+                present = hash_store.presence()
+            metrics.total = len(hash_store)
+            with metrics.stage("exact_match"):
+                first_indices, bucket_of = self._find_exact_buckets(matrix, present)
+                # Buckets renumbered by first occurrence, so seeds are taken in file order
+                order = np.argsort(first_indices, kind="stable")
+                rank = np.empty_like(order)
+                rank[order] = np.arange(len(order))
+                first_indices, bucket_of = first_indices[order], rank[bucket_of]
+                members = np.argsort(bucket_of, kind="stable")
+                member_starts = np.searchsorted(bucket_of[members], np.arange(len(first_indices) + 1))
+            matrix, present = matrix[first_indices], present[first_indices]
+            thresholds = self._type_thresholds(hash_store)
+            tiers = self._tier_columns(hash_store, hash_store.hash_tiers)
+            indexes = None
+            if self.method == "index":
+                with metrics.stage("match"):
+                    indexes = []
+                    for t in tiers[0]:
+                        rows = np.flatnonzero(present[:, t])
+                        indexes.append((t, rows, MultiIndexHash(matrix[rows, t])))
+            else:
+                # Frontier x record tiles are spread over threads, as all_pairs does for find_duplicates
+                max_workers = self.max_workers or os.cpu_count() or 1
+                tile_executor = ThreadPoolExecutor(max_workers=max_workers)
+                first_columns = np.ascontiguousarray(matrix[:, tiers[0]])
+                indexes = (tile_executor, max_workers, first_columns)
+
+            count = len(first_indices)
+            visited = np.zeros(count, dtype=bool)
+            for start in range(0, count, block_size):
+                seeds = start + np.flatnonzero(~visited[start:start + block_size])
+                if not len(seeds):
                     continue
-                img1_hashes = all_image_hashes[image_paths[i]]
-                img2_hashes = all_image_hashes[image_paths[j]]
-
-                all_matching = all(img1_hashes[ht] == img2_hashes[ht] for ht in img1_hashes)
-                some_matching = any(img1_hashes[ht] == img2_hashes[ht] for ht in img1_hashes)
-
-                if all_matching:
-                    duplicate_group.append(image_paths[j])
-                    grouped_images.add(image_paths[j])
-                elif some_matching:
-                    if image_paths[i] not in suspicious_group:
-                        suspicious_group.append(image_paths[i])
-                    suspicious_group.append(image_paths[j])
-                    grouped_images.add(image_paths[j])
-
-            if len(duplicate_group) > 1:
-                duplicate_groups.append(duplicate_group)
-            if len(suspicious_group) > 1:
-                suspicious_groups.append(suspicious_group)
-
-        return duplicate_groups, suspicious_groups
\ No newline at end of file
+                visited[seeds] = True
+                # Every record reached from this block is labelled with a seed; seeds whose groups
+                # meet are merged. Records left over from earlier blocks are never reached again,
+                # because a finished group has no match outside itself.
+                labels = UnionFind(block_size)
+                label_of = {seed: seed - start for seed in seeds.tolist()}
+                frontier = seeds
+                while len(frontier):
+                    with metrics.stage("match"):
+                        source, target = self._expand(frontier, matrix, present, thresholds, tiers, indexes, start)
+                    with metrics.stage("group"):
+                        reached = []
+                        for i, j in zip(source.tolist(), target.tolist()):
+                            if j not in label_of:
+                                label_of[j] = label_of[i]
+                                reached.append(j)
+                            else:
+                                labels.union(label_of[i], label_of[j])
+                        frontier = np.array(reached, dtype=np.int64)
+                        visited[frontier] = True
+
+                components = {}
+                for node, label in label_of.items():
+                    components.setdefault(labels.find(label), []).append(node)
+                nodes = np.fromiter(label_of, dtype=np.int64, count=len(label_of))
+                metrics.advance(int((member_starts[nodes + 1] - member_starts[nodes]).sum()))
+                groups = []
+                for root in sorted(components):
+                    reps = components[root]
+                    image_indices = np.sort(np.concatenate([members[member_starts[r]:member_starts[r + 1]] for r in reps]))
+                    if len(image_indices) < 2:
+                        continue
+                    group = {"type": "duplicate" if len(reps) == 1 else "suspicious",
+                             "images": [hash_store.path(i) for i in image_indices.tolist()]}
+                    if include_hashes:
+                        group["hashes"] = {hash_store.path(i): hash_store.hashes(i) for i in image_indices.tolist()}
+                    metrics.timer.count(group["type"] + "_groups")
+                    groups.append(group)
+                if progress_callback is not None:
+                    progress_callback(metrics.completed / metrics.total * 100)
+                metrics.report()
+                yield from groups
+            metrics.finish()
+        finally:
+            if tile_executor is not None:
+                tile_executor.shutdown(cancel_futures=True)
+            hash_store.close()
+
+    def _expand(self, frontier, matrix, present, thresholds, tiers, indexes, first_open):
+
+        # (source, target) pairs of matching records for every record of the frontier. indexes holds
+        # the first tier's (column, rows, MultiIndexHash) entries, or for the exhaustive method the
+        # tile executor, its size and the first tier's columns. Records before first_open belong to
+        # finished groups, so the exhaustive scan skips them.
+        first = tiers[0]
+        found = []
+        if self.method == "exhaustive":
+            executor, max_workers, first_columns = indexes
+            found.extend(rows_against_all(first_columns, frontier, thresholds[first], executor, max_workers, first_open))
+        else:
+            for t, rows, index in indexes:
+                sources = frontier[present[frontier, t]]
+                k, j, _ = index.query_many(matrix[sources, t], int(thresholds[t]))
+                found.append((sources[k], rows[j]))
+        if not found:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        source = np.concatenate([i for i, _ in found])
+        target = np.concatenate([j for _, j in found])
+        keep = source != target
+        source, target = source[keep], target[keep]
+        if len(tiers) > 1 or not present.all():
+            distances = popcount64(matrix[source] ^ matrix[target])
+            matched = tier_matches(distances, present[source] & present[target], thresholds, tiers)
+            source, target = source[matched], target[matched]
+        return source, target
+
+    def _import_legacy_hashes(self):
+
+        # One-time import of the text hash file older versions wrote by default. Other .txt files
+        # are hash files in their own right and never replace a binary one.
+        legacy_path = os.path.splitext(self.hash_file_path)[0] + ".txt"
+        if (os.path.basename(legacy_path) == LEGACY_RESULT_FILE_PATH and legacy_path != self.hash_file_path
+                and os.path.exists(legacy_path) and not os.path.exists(self.hash_file_path)):
+            import_text_hashes(legacy_path, self.hash_file_path)
+
+    def _load_hash_store(self):
+
+        self._import_legacy_hashes()
+        return HashStore(self.hash_file_path)
+
+    def query(self, hashes):
+
+        # Checks one set of hashes against the persistent reference index of the hash file
+        if self.reference_index is None:
+            self._import_legacy_hashes()
+            self.reference_index = ReferenceIndex(self.hash_file_path)
+        return self.reference_index.query(hashes, self.thresholds)
+
+    def query_images(self, image_paths):
+
+        # Hashes a batch of new images in parallel, then looks each one up in the library
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            computed = list(executor.map(calculate_hashes, image_paths))
+        results = []
+        for image_path, hashes in zip(image_paths, computed):
+            if hashes is None:
+                results.append({"image": image_path, "error": "could not decode image"})
+                continue
+            start = time.perf_counter()
+            matches = self.query(hashes)
+            results.append({"image": image_path, "hashes": hashes, "matches": matches,
+                            "query_ms": (time.perf_counter() - start) * 1000})
+        return results
+
+    def close(self):
+
+        if self.reference_index is not None:
+            self.reference_index.close()
+            self.reference_index = None
+
+    def _tier_columns(self, hash_store, tiers):
+
+        columns = [[hash_store.hash_types.index(hash_type) for hash_type in tier if hash_type in hash_store.hash_types]
+                   for tier in tiers]
+        return [tier for tier in columns if tier]
+
+    def _find_exact_buckets(self, matrix, present):
+
+        # One sort-based pass over the combined hash tuples; rows with identical tuples share a bucket.
+        # Presence is part of the tuple, so a missing hash never equals a stored zero.
+        if not present.all():
+            matrix = np.column_stack([matrix, present])
+        rows = np.ascontiguousarray(matrix).view(np.dtype((np.void, matrix.dtype.itemsize * matrix.shape[1])))
+        _, first_indices, bucket_of = np.unique(rows.ravel(), return_index=True, return_inverse=True)
+        return first_indices, bucket_of.ravel()
+
+    def _type_thresholds(self, hash_store):
+
+        # Earlier tiers of a cascaded store only decide candidates, at the distances chosen when it
+        # was hashed; images beyond those never got the later tiers, so a requested threshold can
+        # tighten them but not loosen them
+        thresholds = dict(self.thresholds)
+        for hash_type, limit in hash_store.metadata.get("candidate_thresholds", {}).items():
+            thresholds[hash_type] = min(self.requested_thresholds.get(hash_type, limit), limit)
+        return np.array([thresholds.get(hash_type, 0) for hash_type in hash_store.hash_types])
+
+    def _find_matching_pairs(self, matrix, present, thresholds, tiers):
+
+        # Pairs are found on the first tier; later tiers and missing hashes are then checked per pair
+        first = tiers[0]
+        if self.method == "exhaustive":
+            found = [(i, j) for i, j, _ in all_pairs(matrix[:, first], thresholds[first], max_workers=self.max_workers)]
+        else:
+            found = []
+            for t in first:
+                rows = np.flatnonzero(present[:, t])
+                found.extend((rows[i], rows[j]) for i, j, _ in MultiIndexHash(matrix[rows, t]).pairs(int(thresholds[t])))
+        if not found:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        pair_i, pair_j = np.concatenate([i for i, _ in found]), np.concatenate([j for _, j in found])
+        if len(tiers) > 1 or not present.all():
+            distances = popcount64(matrix[pair_i] ^ matrix[pair_j])
+            matched = tier_matches(distances, present[pair_i] & present[pair_j], thresholds, tiers)
+            pair_i, pair_j = pair_i[matched], pair_j[matched]
+        return pair_i, pair_j
+
+    def candidates(self, hash_store, level):
+
+        # Records the first `level` tiers of the store put in a group, i.e. those worth a later tier
+        matrix = hash_store.matrix()
+        present = hash_store.presence()
+        first_indices, bucket_of = self._find_exact_buckets(matrix, present)
+        pair_i, pair_j = self._find_matching_pairs(matrix[first_indices], present[first_indices],
+                                                   self._type_thresholds(hash_store),
+                                                   self._tier_columns(hash_store, hash_store.hash_tiers[:level]))
+        component_of = self._components(len(first_indices), pair_i, pair_j)[bucket_of]
+        _, group_of, sizes = np.unique(component_of, return_inverse=True, return_counts=True)
+        return np.flatnonzero(sizes[group_of.ravel()] > 1)
+
+    def _find_duplicates_and_suspicious(self, hash_store):
+
+        metrics = self.metrics or PipelineMetrics("analysis")
+        with metrics.stage("parse"):
+            image_paths = hash_store.paths()
+            matrix = hash_store.matrix()
+            present = hash_store.presence()
+        with metrics.stage("exact_match"):
+            first_indices, bucket_of = self._find_exact_buckets(matrix, present)
+
+        # Near-duplicate search runs on one representative per distinct hash tuple, and
+        # union-find merges the matching pairs so groups are transitive and order-independent
+        with metrics.stage("match"):
+            pair_i, pair_j = self._find_matching_pairs(matrix[first_indices], present[first_indices],
+                                                       self._type_thresholds(hash_store),
+                                                       self._tier_columns(hash_store, hash_store.hash_tiers))
+        metrics.timer.count("matching_pairs", len(pair_i))
+        with metrics.stage("group"):
+            return self._group(image_paths, first_indices, bucket_of, pair_i, pair_j)
+
+    def _components(self, count, pair_i, pair_j):
+
+        buckets = UnionFind(count)
+        for i, j in zip(pair_i.tolist(), pair_j.tolist()):
+            buckets.union(i, j)
+        return buckets.roots()
+
+    def _group(self, image_paths, first_indices, bucket_of, pair_i, pair_j):
+
+        component_of = self._components(len(first_indices), pair_i, pair_j)[bucket_of]
+
+        # Stable sort keeps members in file order; groups are reported by their first member
+        order = np.argsort(component_of, kind="stable")
+        _, starts, sizes = np.unique(component_of[order], return_index=True, return_counts=True)
+        groups = sorted((order[start:start + size] for start, size in zip(starts[sizes > 1], sizes[sizes > 1])),
+                        key=lambda members: members[0])
+
+        duplicate_groups = []
+        suspicious_groups = []
+        for members in groups:
+            group = [image_paths[i] for i in members]
+            if len(np.unique(bucket_of[members])) == 1:
+                duplicate_groups.append(group)
+            else:
+                suspicious_groups.append(group)
+        return duplicate_groups, suspicious_groups
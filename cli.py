@@ -0,0 +1,276 @@
+import argparse
+import json
+import os
+import signal
+import sys
+import tempfile
+from contextlib import contextmanager
+from itertools import chain
+from calculation import HashCalculator, DuplicateAnalyzer, DEFAULT_MEMORY_BUDGET, DEFAULT_THRESHOLDS
+from hash_store import import_text_hashes
+from reference import ReferenceIndex
+from shards import merge_shards
+from watcher import (DEFAULT_DEBOUNCE, DEFAULT_FULL_SCAN_INTERVAL, DEFAULT_MERGE_INTERVAL, DEFAULT_POLL_INTERVAL,
+                     FolderWatcher)
+
+# Exit codes shared by every subcommand
+EXIT_OK = 0
+EXIT_MATCHES_FOUND = 1
+EXIT_ERROR = 2
+
+def parse_threshold(value):
+
+    hash_type, _, distance = value.partition("=")
+    if hash_type not in DEFAULT_THRESHOLDS or not distance.isdigit():
+        raise argparse.ArgumentTypeError(f"Expected <hash type>=<distance>, e.g. PHash=6, got {value!r}")
+    return hash_type, int(distance)
+
+def parse_hash_tier(value):
+
+    hash_types = [hash_type.strip() for hash_type in value.split(",")]
+    unknown = [hash_type for hash_type in hash_types if hash_type not in DEFAULT_THRESHOLDS]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unknown hash types {unknown}; choose from {', '.join(DEFAULT_THRESHOLDS)}")
+    return hash_types
+
+def write_output(records, output_format, json_key):
+
+    # JSONL streams one record per line as it arrives; JSON wraps everything in a single document
+    if output_format == "jsonl":
+        for record in records:
+            sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+            sys.stdout.flush()
+    else:
+        json.dump({json_key: list(records)}, sys.stdout, ensure_ascii=False, indent=2)
+        sys.stdout.write("\n")
+
+@contextmanager
+def readable_hashes(hashes_path):
+
+    # Text hash files written by 'index --hashes x.txt' are imported into a temporary store,
+    # since the analysis works on the memory-mapped binary format
+    if not hashes_path.lower().endswith(".txt"):
+        yield hashes_path
+        return
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store_path = os.path.join(temp_dir, "image_hashes.bin")
+        import_text_hashes(hashes_path, store_path)
+        yield store_path
+
+def make_analyzer(args, hashes_path):
+
+    return DuplicateAnalyzer(hashes_path, thresholds=dict(args.threshold or []),
+                             method=getattr(args, "method", "index"), max_workers=args.workers,
+                             metrics_path=args.metrics_json, profile=args.profile)
+
+def run_index(args):
+
+    if (args.shard_count > 1 or len(args.hash_tier or []) > 1) and args.hashes.lower().endswith(".txt"):
+        print("Shard files and cascaded hashing need the binary format (.bin)", file=sys.stderr)
+        return EXIT_ERROR
+    summary = {}
+    try:
+        calculator = HashCalculator(engine=args.engine, max_workers=args.workers, chunk_size=args.chunk_size,
+                                    cache_file_path=args.cache, metrics_path=args.metrics_json, profile=args.profile,
+                                    identical_callback=lambda groups: summary.update(identical_groups=len(groups)),
+                                    shard_count=args.shard_count, shard_id=args.shard_id, root_id=args.root_id,
+                                    memory_budget=args.memory_budget_mb * 1024 * 1024, hash_tiers=args.hash_tier,
+                                    thresholds=dict(args.threshold or []), checkpoint_interval=args.checkpoint_interval)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return EXIT_ERROR
+    calculator.result_file_path = args.hashes
+    folder = args.folder
+    if folder is None and args.resume:
+        folder = calculator.interrupted_folder()
+        if folder is None:
+            print(f"No interrupted run recorded in {args.cache}", file=sys.stderr)
+            return EXIT_ERROR
+    if folder is None or not os.path.isdir(folder):
+        print(f"Not a folder: {folder}", file=sys.stderr)
+        return EXIT_ERROR
+
+    def progress_callback(value, stats=None):
+        summary.update(stats or {})
+        if not args.quiet:
+            print(f"\r{value:6.2f}%", end="", file=sys.stderr, flush=True)
+
+    # Ctrl-C cancels cleanly: batches already with the workers finish and are journaled
+    previous_handler = signal.signal(signal.SIGINT, lambda signum, frame: calculator.cancel())
+    try:
+        calculator.calculate_hashes(folder, progress_callback, lambda success: summary.update(success=success))
+    finally:
+        signal.signal(signal.SIGINT, previous_handler)
+    if not args.quiet:
+        print(file=sys.stderr)
+    if calculator.cancelled():
+        print("Cancelled; run index again with --resume to continue where it stopped", file=sys.stderr)
+    if args.reference_index and summary.get("success"):
+        # Otherwise the first query after this run builds it
+        ReferenceIndex(args.hashes).build()
+    write_output([dict(summary, folder=folder, hashes=args.hashes)], args.format, "index")
+    return EXIT_OK if summary.get("success") else EXIT_ERROR
+
+def run_merge(args):
+
+    try:
+        count, missing = merge_shards(args.shards, args.hashes, args.root, args.allow_missing)
+    except (OSError, ValueError) as e:
+        print(f"Cannot merge shards: {e}", file=sys.stderr)
+        return EXIT_ERROR
+    write_output([{"hashes": args.hashes, "images": count, "shards": len(args.shards), "missing_shards": missing}],
+                 args.format, "merge")
+    return EXIT_OK
+
+def run_watch(args):
+
+    if not os.path.isdir(args.folder):
+        print(f"Not a folder: {args.folder}", file=sys.stderr)
+        return EXIT_ERROR
+    if args.hashes.lower().endswith(".txt"):
+        print("Watch mode needs the binary format (.bin)", file=sys.stderr)
+        return EXIT_ERROR
+    calculator = HashCalculator(engine=args.engine, max_workers=args.workers, chunk_size=args.chunk_size,
+                                cache_file_path=args.cache, memory_budget=args.memory_budget_mb * 1024 * 1024)
+    calculator.result_file_path = args.hashes
+
+    def batch_callback(summary):
+        write_output([summary], args.format, "batch")
+        sys.stdout.flush()
+
+    # Catches up with the folder first, then prints one record per applied batch until interrupted
+    watcher = FolderWatcher(args.folder, calculator, make_analyzer(args, args.hashes), batch_callback,
+                            interval=args.interval, debounce=args.debounce,
+                            full_scan_interval=args.full_scan_interval, merge_interval=args.merge_interval)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    return EXIT_OK
+
+def run_find_dupes(args):
+
+    if not os.path.exists(args.hashes):
+        print(f"Hash file not found: {args.hashes} (run 'index' first)", file=sys.stderr)
+        return EXIT_ERROR
+    # Groups are written as the analyzer finalises them, ordered by their first image
+    with readable_hashes(args.hashes) as hashes_path:
+        groups = make_analyzer(args, hashes_path).iter_groups()
+        first = next(groups, None)
+        write_output([] if first is None else chain([first], groups), args.format, "groups")
+    return EXIT_MATCHES_FOUND if first is not None else EXIT_OK
+
+def run_query(args):
+
+    if not os.path.exists(args.hashes):
+        print(f"Hash file not found: {args.hashes} (run 'index' first)", file=sys.stderr)
+        return EXIT_ERROR
+    with readable_hashes(args.hashes) as hashes_path:
+        analyzer = make_analyzer(args, hashes_path)
+        try:
+            results = analyzer.query_images(args.images)
+        finally:
+            analyzer.close()
+    write_output(results, args.format, "queries")
+    if any("error" in result for result in results):
+        return EXIT_ERROR
+    return EXIT_MATCHES_FOUND if any(result["matches"] for result in results) else EXIT_OK
+
+def build_parser():
+
+    # Options every subcommand accepts after its name
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--hashes", default=HashCalculator.result_file_path, help="Hash file to write or read")
+    common.add_argument("--format", choices=("json", "jsonl"), default="json")
+    common.add_argument("--workers", type=int, default=None, help="Worker count (default: CPU count)")
+    common.add_argument("--metrics-json", help="Write per-stage timings, counters and throughput to this file")
+    common.add_argument("--profile", action="store_true",
+                        help="Add cProfile and tracemalloc results to the metrics summary")
+
+    parser = argparse.ArgumentParser(
+        description="Headless image plagiarism check",
+        epilog=f"Exit codes: {EXIT_OK} = nothing found, {EXIT_MATCHES_FOUND} = duplicates or matches found, "
+               f"{EXIT_ERROR} = error."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = subparsers.add_parser("index", parents=[common], help="Hash every image in a folder")
+    index_parser.add_argument("folder", nargs="?", help="Folder to hash; may be left out with --resume")
+    index_parser.add_argument("--resume", action="store_true",
+                              help="Continue the run that was cancelled or interrupted; finished images are not rehashed")
+    index_parser.add_argument("--checkpoint-interval", type=float, default=30,
+                              help="Seconds between durable checkpoints of finished images")
+    index_parser.add_argument("--engine", choices=HashCalculator.ENGINES, default="process")
+    index_parser.add_argument("--chunk-size", type=int, default=16)
+    index_parser.add_argument("--cache", default="image_hashes.cache")
+    index_parser.add_argument("--quiet", action="store_true", help="Do not print progress to stderr")
+    index_parser.add_argument("--reference-index", action="store_true",
+                              help="Also rebuild the persistent index used by 'query'")
+    index_parser.add_argument("--memory-budget-mb", type=int, default=DEFAULT_MEMORY_BUDGET // (1024 * 1024),
+                              help="Memory all workers together may spend on decoded images")
+    index_parser.add_argument("--hash-tier", type=parse_hash_tier, action="append",
+                              help="Comma-separated hash types, e.g. --hash-tier DHash,AHash (repeatable). Each "
+                                   "further tier is only computed for images the earlier tiers found candidates for")
+    index_parser.add_argument("--threshold", type=parse_threshold, action="append",
+                              help="Distance at which earlier tiers make images candidates, e.g. DHash=8 (repeatable)")
+    index_parser.add_argument("--shard-count", type=int, default=1,
+                              help="Split the folder into this many shards and hash only one of them")
+    index_parser.add_argument("--shard-id", type=int, default=0, help="Shard to hash, 0..shard-count-1")
+    index_parser.add_argument("--root-id", help="Name of the archive recorded in shard files (default: folder name)")
+    index_parser.set_defaults(handler=run_index)
+
+    watch_parser = subparsers.add_parser("watch", parents=[common],
+                                         help="Keep the hash file up to date and check new images as they arrive")
+    watch_parser.add_argument("folder")
+    watch_parser.add_argument("--engine", choices=HashCalculator.ENGINES, default="process")
+    watch_parser.add_argument("--chunk-size", type=int, default=16)
+    watch_parser.add_argument("--cache", default="image_hashes.cache")
+    watch_parser.add_argument("--memory-budget-mb", type=int, default=DEFAULT_MEMORY_BUDGET // (1024 * 1024),
+                              help="Memory all workers together may spend on decoded images")
+    watch_parser.add_argument("--interval", type=float, default=DEFAULT_POLL_INTERVAL, help="Seconds between folder scans")
+    watch_parser.add_argument("--debounce", type=float, default=DEFAULT_DEBOUNCE,
+                              help="Seconds the folder must stay unchanged before a batch is applied")
+    watch_parser.add_argument("--full-scan-interval", type=float, default=DEFAULT_FULL_SCAN_INTERVAL,
+                              help="Seconds between full rescans, which find files rewritten in place; "
+                                   "scans in between only relist directories that changed")
+    watch_parser.add_argument("--merge-interval", type=float, default=DEFAULT_MERGE_INTERVAL,
+                              help="Seconds between rewrites of the hash file; batches in between only "
+                                   "append to the cache journal")
+    watch_parser.add_argument("--threshold", type=parse_threshold, action="append",
+                              help="Per-type Hamming threshold for new arrivals, e.g. --threshold PHash=8 (repeatable)")
+    watch_parser.set_defaults(handler=run_watch)
+
+    merge_parser = subparsers.add_parser("merge", parents=[common], help="Combine shard files into one hash file")
+    merge_parser.add_argument("shards", nargs="+")
+    merge_parser.add_argument("--root", help="Local path of the archive; stored paths are resolved against it")
+    merge_parser.add_argument("--allow-missing", action="store_true", help="Merge even if some shards are absent")
+    merge_parser.set_defaults(handler=run_merge)
+
+    for name, handler, help_text in (("find-dupes", run_find_dupes, "Find duplicate and suspicious groups"),
+                                     ("query", run_query, "Check images against the index")):
+        subparser = subparsers.add_parser(name, parents=[common], help=help_text)
+        if name == "query":
+            subparser.add_argument("images", nargs="+")
+        else:
+            subparser.add_argument("--method", choices=DuplicateAnalyzer.METHODS, default="index")
+        subparser.add_argument("--threshold", type=parse_threshold, action="append",
+                               help="Per-type Hamming threshold, e.g. --threshold PHash=8 (repeatable)")
+        subparser.set_defaults(handler=handler)
+    return parser
+
+def main(argv=None):
+
+    args = build_parser().parse_args(argv)
+    try:
+        return args.handler(args)
+    except (OSError, ValueError) as e:
+        # An uncaught exception would exit with 1, which callers read as "matches found"
+        print(f"{args.command}: {e}", file=sys.stderr)
+        return EXIT_ERROR
+    except Exception as e:
+        # Anything else, e.g. a worker pool that could not be recovered, is an error exit all the same
+        print(f"{args.command}: {type(e).__name__}: {e}", file=sys.stderr)
+        return EXIT_ERROR
+
+if __name__ == "__main__":
+    sys.exit(main())
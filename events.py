@@ -0,0 +1,136 @@
+import threading
+import time
+from collections import deque
+
+# Frames per second at which queued events are handed to the UI
+DEFAULT_FRAME_RATE = 20
+# Log lines held between two frames; older ones are counted and dropped during a burst
+MAX_PENDING_LOG_LINES = 500
+# Seconds of history the throughput and ETA are averaged over
+RATE_WINDOW = 5.0
+
+def format_duration(seconds):
+
+    seconds = int(seconds + 0.5)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+class RateMeter:
+    def __init__(self, window=RATE_WINDOW):
+
+        self.window = window
+        self.samples = deque()
+
+    def add(self, value, now):
+
+        # A value going backwards means a new run or phase started; its rate starts over
+        if self.samples and value < self.samples[-1][1]:
+            self.samples.clear()
+        self.samples.append((now, value))
+        # One sample older than the window is kept, so the rate always spans the whole window
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.window:
+            self.samples.popleft()
+
+    def rate(self):
+
+        if len(self.samples) < 2:
+            return None
+        (start, first), (end, last) = self.samples[0], self.samples[-1]
+        return (last - first) / (end - start) if end > start else None
+
+    def clear(self):
+
+        self.samples.clear()
+
+# Collects progress, metrics, log events and UI calls from any thread. Progress and metrics only
+# keep the latest value, log lines queue up to a bound, and the UI thread drains everything at
+# most once per frame, so a run that reports per file costs the event loop one update per frame.
+class EventBus:
+    def __init__(self, frame_rate=DEFAULT_FRAME_RATE, window=RATE_WINDOW, max_log_lines=MAX_PENDING_LOG_LINES):
+
+        self.frame_interval = 1.0 / frame_rate
+        self.lock = threading.Lock()
+        self.progress_meter = RateMeter(window)
+        self.item_meter = RateMeter(window)
+        self.log_lines = deque(maxlen=max_log_lines)
+        self.dropped_lines = 0
+        self.calls = []
+        self.value = None
+        self.completed = None
+        self.total = None
+        self.changed = False
+
+    def progress(self, value, now=None):
+
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.value = value
+            self.progress_meter.add(value, now)
+            self.changed = True
+
+    def metrics(self, snapshot, now=None):
+
+        # PipelineMetrics snapshots carry the item counts the throughput is measured in
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.completed = snapshot["completed"]
+            self.total = snapshot["total"]
+            self.item_meter.add(self.completed, now)
+            self.changed = True
+
+    def log(self, message):
+
+        with self.lock:
+            if len(self.log_lines) == self.log_lines.maxlen:
+                self.dropped_lines += 1
+            self.log_lines.append(message)
+            self.changed = True
+
+    def call(self, callback, *args):
+
+        # Widget work a worker thread needs done, e.g. showing results; run in order, never dropped
+        with self.lock:
+            self.calls.append((callback, args))
+            self.changed = True
+
+    def reset(self):
+
+        # Forgets pending progress and rates, e.g. when a run ends or a new one starts; log lines stay
+        with self.lock:
+            self.value = self.completed = self.total = None
+            self.progress_meter.clear()
+            self.item_meter.clear()
+
+    def drain(self):
+
+        # Everything that happened since the last frame, or None if nothing did
+        with self.lock:
+            if not self.changed:
+                return None
+            frame = {
+                "progress": self.value,
+                "completed": self.completed,
+                "total": self.total,
+                "throughput_per_s": self.item_meter.rate(),
+                "eta_s": self._eta(),
+                "log": list(self.log_lines),
+                "dropped_lines": self.dropped_lines,
+                "calls": self.calls,
+            }
+            self.calls = []
+            self.log_lines.clear()
+            self.dropped_lines = 0
+            self.changed = False
+        return frame
+
+    def _eta(self):
+
+        # Item counts give the better estimate; percentages cover pipelines that only report those
+        throughput = self.item_meter.rate()
+        if throughput and self.total is not None:
+            return max(self.total - self.completed, 0) / throughput
+        rate = self.progress_meter.rate()
+        if rate and self.value is not None:
+            return max(100 - self.value, 0) / rate
+        return None
@@ -0,0 +1,156 @@
+import hashlib
+import os
+
+# Bytes read from each end of a file for the partial digest
+PARTIAL_DIGEST_SIZE = 64 * 1024
+
+def partial_digest(file_path, block_size=PARTIAL_DIGEST_SIZE):
+
+    # First and last block; enough to tell apart almost every pair of same-size images
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        digest.update(f.read(block_size))
+        size = f.seek(0, os.SEEK_END)
+        if size > block_size:
+            f.seek(max(size - block_size, block_size))
+            digest.update(f.read(block_size))
+    return digest.hexdigest()
+
+def full_digest(file_path, chunk_size=1 << 20):
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _safe_digest(digest_function):
+
+    def digest(file_path):
+        try:
+            return digest_function(file_path)
+        except OSError:
+            # Unreadable files simply drop out and are handled by the normal hashing path
+            return None
+    return digest
+
+# Incremental form of the size -> partial digest -> full digest narrowing, for files that
+# arrive from a scan. Each level is a dict, so placing a file costs a few lookups however many
+# files share its size. A key held by a single file is only split by the next digest once a
+# second file arrives, so files with a unique size are never read.
+class IdenticalFiles:
+    def __init__(self, executor=None):
+
+        # Digests are read on this executor, not on the thread that places the files
+        self.executor = executor
+        self.by_size = {}
+        self.known = {}
+        self.partial_digests = {}
+        self.full_digests = {}
+        self.copies = {}
+
+    def _levels(self, size):
+
+        # The partial digest already covered every byte of small files
+        levels = [(self.partial_digests, partial_digest)]
+        if size > 2 * PARTIAL_DIGEST_SIZE:
+            levels.append((self.full_digests, full_digest))
+        return levels
+
+    def _prefetch(self, digests, digest_function, file_paths):
+
+        file_paths = [file_path for file_path in dict.fromkeys(file_paths) if file_path not in digests]
+        if not file_paths:
+            return
+        mapper = map if self.executor is None else self.executor.map
+        digests.update(zip(file_paths, mapper(_safe_digest(digest_function), file_paths)))
+
+    def _key(self, digests, digest_function, file_path):
+
+        if file_path not in digests:
+            digests[file_path] = _safe_digest(digest_function)(file_path)
+        # An unreadable file gets a key of its own, so it never matches anything
+        return digests[file_path] or ("unreadable", file_path)
+
+    def _place(self, buckets, key, file_path, levels):
+
+        # buckets maps key -> file, or key -> buckets of the next level once two files share the key.
+        # Returns the file already holding the same content, or None after adding this one.
+        entry = buckets.get(key)
+        if entry is None:
+            buckets[key] = file_path
+            return None
+        if not levels:
+            return entry
+        digests, digest_function = levels[0]
+        if not isinstance(entry, dict):
+            entry = buckets[key] = {self._key(digests, digest_function, entry): entry}
+        return self._place(entry, self._key(digests, digest_function, file_path), file_path, levels[1:])
+
+    def _partial_level(self, size):
+
+        # partial digest -> file or full-digest buckets for the files already placed at this size
+        entry = self.by_size.get(size)
+        if entry is None or isinstance(entry, dict):
+            return entry or {}
+        return {self._key(self.partial_digests, partial_digest, entry): entry}
+
+    def add_known(self, file_path, size):
+
+        # Files whose hashes are already known are only read if a new file of the same size turns up
+        self.known.setdefault(size, []).append(file_path)
+
+    def _place_known(self, size):
+
+        for file_path in self.known.pop(size, []):
+            self._place(self.by_size, size, file_path, self._levels(size))
+
+    def add(self, file_path, size):
+
+        return self.add_many([(file_path, size)])[0]
+
+    def add_many(self, files):
+
+        # files are (path, size) pairs; returns the earlier file with the same content for each,
+        # or None if it is new. The digests the placement will ask for are read in parallel first.
+        counts = {}
+        for _, size in files:
+            counts[size] = counts.get(size, 0) + 1
+        shared = {size for size, count in counts.items() if count > 1 or size in self.by_size or size in self.known}
+        if shared:
+            # Known files of those sizes are placed now too, so they are read along with the batch
+            incoming = [(file_path, size) for size in shared for file_path in self.known.get(size, [])]
+            incoming += [(file_path, size) for file_path, size in files if size in shared]
+            # A size held by one file so far has no digest yet either
+            self._prefetch(self.partial_digests, partial_digest,
+                           [file_path for file_path, _ in incoming]
+                           + [entry for entry in map(self.by_size.get, shared) if isinstance(entry, str)])
+            # Full digests only for large files whose partial digest is not unique
+            large = [(file_path, size, self._key(self.partial_digests, partial_digest, file_path))
+                     for file_path, size in incoming if size > 2 * PARTIAL_DIGEST_SIZE]
+            partial_counts = {}
+            for _, size, partial in large:
+                partial_counts[(size, partial)] = partial_counts.get((size, partial), 0) + 1
+            levels = {size: self._partial_level(size) for _, size, _ in large}
+            needed = []
+            for file_path, size, partial in large:
+                held = levels[size].get(partial)
+                if partial_counts[(size, partial)] > 1 or held is not None:
+                    needed.append(file_path)
+                    if isinstance(held, str):
+                        needed.append(held)
+            self._prefetch(self.full_digests, full_digest, needed)
+            for size in shared:
+                self._place_known(size)
+
+        originals = []
+        for file_path, size in files:
+            original = self._place(self.by_size, size, file_path, self._levels(size))
+            if original is not None:
+                self.copies.setdefault(original, []).append(file_path)
+            originals.append(original)
+        return originals
+
+    def groups(self):
+
+        return [[original] + copies for original, copies in self.copies.items()]
@@ -0,0 +1,136 @@
+import json
+import os
+
+
+def file_signature(stat_result, use_inode=False):
+
+    return (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino if use_inode else 0)
+
+class HashCache:
+    def __init__(self, cache_file_path="image_hashes.cache", use_inode=False):
+
+        self.cache_file_path = cache_file_path
+        self.use_inode = use_inode
+        # Entries updated during a run are appended here as well, so a crash or cancel keeps them
+        self.journal_path = cache_file_path + ".journal"
+        # The journal's run header, kept apart so finding an interrupted run does not read the journal
+        self.run_path = cache_file_path + ".run"
+        self.journal = None
+        self.journal_lines = []
+        self.entries = {}
+
+    def load(self):
+
+        # The journal of an unfinished run is replayed on top of the last full save
+        self.entries = {}
+        for file_path in (self.cache_file_path, self.journal_path):
+            if not os.path.exists(file_path):
+                continue
+            with open(file_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        if entry.get("deleted"):
+                            self.entries.pop(entry["path"], None)
+                            continue
+                        self.entries[entry["path"]] = (tuple(entry["signature"]), entry["hashes"])
+                    except (ValueError, KeyError, TypeError):
+                        # A torn last line from an interrupted write, or a journal run header
+                        continue
+
+    def save(self):
+
+        temp_path = self.cache_file_path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for image_path, (signature, hashes) in self.entries.items():
+                f.write(self._entry_line(image_path, signature, hashes))
+        os.replace(temp_path, self.cache_file_path)
+        # Everything the journal held is in the full save now
+        self.close_journal()
+        for file_path in (self.journal_path, self.run_path):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def _entry_line(self, image_path, signature, hashes):
+
+        return json.dumps({"path": image_path, "signature": signature, "hashes": hashes}, ensure_ascii=False) + "\n"
+
+    def start_journal(self, run_info):
+
+        # run_info is recorded so an interrupted run can be found and resumed later
+        with open(self.run_path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(run_info, f, ensure_ascii=False)
+        os.replace(self.run_path + ".tmp", self.run_path)
+        with open(self.journal_path, 'ab') as f:
+            if f.tell() and not self._ends_with_newline():
+                # Do not glue the first new entry onto a line torn by a crash
+                f.write(b"\n")
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+        self.journal_lines = [json.dumps({"run": run_info}, ensure_ascii=False) + "\n"]
+        self.checkpoint()
+
+    def _ends_with_newline(self):
+
+        with open(self.journal_path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def checkpoint(self):
+
+        # Makes every entry updated so far durable
+        if self.journal is None:
+            return
+        self.journal.writelines(self.journal_lines)
+        self.journal_lines = []
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def close_journal(self):
+
+        if self.journal is not None:
+            self.checkpoint()
+            self.journal.close()
+            self.journal = None
+
+    def interrupted_run(self):
+
+        # run_info of the last run that stopped before its final save, or None
+        if not os.path.exists(self.journal_path):
+            return None
+        try:
+            with open(self.run_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def lookup(self, image_path, signature):
+
+        # Returns (True, hashes) on a hit; hashes is None for files that previously failed to decode
+        entry = self.entries.get(image_path)
+        if entry is None or entry[0] != signature:
+            return False, None
+        return True, entry[1]
+
+    def update(self, image_path, signature, hashes):
+
+        # Unchanged entries (cache hits) are not journaled again
+        if self.journal is not None and self.entries.get(image_path) != (signature, hashes):
+            self.journal_lines.append(self._entry_line(image_path, signature, hashes))
+        self.entries[image_path] = (signature, hashes)
+
+    def discard(self, image_path):
+
+        if self.entries.pop(image_path, None) is not None and self.journal is not None:
+            self.journal_lines.append(json.dumps({"path": image_path, "deleted": True}, ensure_ascii=False) + "\n")
+
+    def prune(self, folder_path, seen_paths, in_scope=None):
+
+        # Drop entries under folder_path that were not found by the latest scan; in_scope limits
+        # this to the files the scan was responsible for, e.g. one shard of the folder
+        prefix = os.path.join(os.path.abspath(folder_path), "")
+        stale = [image_path for image_path in self.entries
+                 if os.path.abspath(image_path).startswith(prefix) and image_path not in seen_paths
+                 and (in_scope is None or in_scope(image_path))]
+        for image_path in stale:
+            del self.entries[image_path]
+        return len(stale)
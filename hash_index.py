@@ -0,0 +1,272 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
+import numpy as np
+
+HASH_BITS = 64
+
+def popcount64(values):
+
+    values = np.asarray(values, dtype=np.uint64)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values).astype(np.uint8)
+    # SWAR popcount for NumPy releases without bitwise_count
+    values = values - ((values >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    values = (values & np.uint64(0x3333333333333333)) + ((values >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    values = (values + (values >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return ((values * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(np.uint8)
+
+def hamming_distance(a, b):
+
+    return popcount64(np.bitwise_xor(a, b))
+
+def tier_matches(distances, comparable, thresholds, tiers):
+
+    # distances and comparable are (pairs, hash types); tiers are lists of columns, cheapest first.
+    # A pair must match on some type of the first tier, and on some type of every later tier
+    # that both records have hashes for; a tier either record lacks neither confirms nor rejects.
+    close = comparable & (distances <= thresholds)
+    matched = close[:, tiers[0]].any(axis=1)
+    for tier in tiers[1:]:
+        matched &= close[:, tier].any(axis=1) | ~comparable[:, tier].any(axis=1)
+    return matched
+
+def _expand_ranges(lo, hi):
+
+    # Concatenation of arange(lo[k], hi[k]) for every k, plus the owner k of each element
+    counts = hi - lo
+    total = int(counts.sum())
+    owners = np.repeat(np.arange(len(lo)), counts)
+    if total == 0:
+        return np.empty(0, dtype=np.int64), owners
+    positions = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(total)
+    return positions, owners
+
+# Multi-index hashing: two hashes within distance r differ in at most r // chunk_count bits
+# on at least one of their substrings, so a range query only probes that small neighbourhood
+# of each sorted substring table instead of scanning the whole corpus.
+class MultiIndexHash:
+    def __init__(self, values, chunk_count=4, orders=None, keys=None):
+
+        self.values = np.asarray(values, dtype=np.uint64)
+        self.chunk_count = chunk_count
+        self.chunk_bits = HASH_BITS // chunk_count
+        self.chunk_mask = np.uint64((1 << self.chunk_bits) - 1)
+        self.key_dtype = np.uint16 if self.chunk_bits <= 16 else np.uint32 if self.chunk_bits <= 32 else np.uint64
+        self.probe_masks = {}
+        if orders is not None:
+            # Prebuilt tables, e.g. memory-mapped from disk by load()
+            self.orders, self.keys = orders, keys
+            return
+        order_dtype = np.uint32 if len(self.values) < 2 ** 32 else np.int64
+        self.orders = np.empty((chunk_count, len(self.values)), dtype=order_dtype)
+        self.keys = np.empty((chunk_count, len(self.values)), dtype=self.key_dtype)
+        for m in range(chunk_count):
+            chunk = self._chunk(self.values, m).astype(self.key_dtype)
+            order = np.argsort(chunk, kind="stable")
+            self.orders[m] = order
+            self.keys[m] = chunk[order]
+
+    def save(self, path_prefix):
+
+        np.save(path_prefix + ".orders.npy", self.orders)
+        np.save(path_prefix + ".keys.npy", self.keys)
+
+    @classmethod
+    def load(cls, values, path_prefix, chunk_count=4):
+
+        orders = np.load(path_prefix + ".orders.npy", mmap_mode="r")
+        keys = np.load(path_prefix + ".keys.npy", mmap_mode="r")
+        return cls(values, chunk_count, orders, keys)
+
+    def __len__(self):
+
+        return len(self.values)
+
+    def _chunk(self, values, m):
+
+        return (values >> np.uint64(m * self.chunk_bits)) & self.chunk_mask
+
+    def _masks(self, radius):
+
+        # Every substring offset with at most radius // chunk_count bits set
+        flips = min(radius // self.chunk_count, self.chunk_bits)
+        if flips not in self.probe_masks:
+            masks = [0]
+            for k in range(1, flips + 1):
+                masks.extend(sum(1 << bit for bit in bits) for bits in combinations(range(self.chunk_bits), k))
+            self.probe_masks[flips] = np.array(masks, dtype=np.uint64)
+        return self.probe_masks[flips]
+
+    def _lookup(self, m, probes):
+
+        # Searching in sorted order keeps the binary searches cache-friendly for big probe sets
+        probes = probes.astype(self.key_dtype)
+        order = np.argsort(probes)
+        lo = np.empty(len(probes), dtype=np.int64)
+        hi = np.empty(len(probes), dtype=np.int64)
+        lo[order] = np.searchsorted(self.keys[m], probes[order], side="left")
+        hi[order] = np.searchsorted(self.keys[m], probes[order], side="right")
+        return lo, hi
+
+    def candidates(self, value, radius):
+
+        masks = self._masks(radius)
+        found = []
+        for m in range(self.chunk_count):
+            probes = self._chunk(np.uint64(value), m) ^ masks
+            lo, hi = self._lookup(m, probes)
+            positions, _ = _expand_ranges(lo, hi)
+            found.append(self.orders[m][positions])
+        return np.unique(np.concatenate(found))
+
+    def query(self, value, radius):
+
+        indices = self.candidates(value, radius)
+        distances = hamming_distance(self.values[indices], np.uint64(value))
+        within = distances <= radius
+        return indices[within], distances[within]
+
+    def _probe(self, values, radius, max_candidates):
+
+        # Yields (k, j) arrays: record j shares a probed substring neighbourhood with values[k]
+        masks = self._masks(radius)
+        for m in range(self.chunk_count):
+            probes = (self._chunk(values, m)[:, None] ^ masks[None, :]).ravel()
+            lo, hi = self._lookup(m, probes)
+            # Bound the candidate buffer even when many hashes share one substring
+            ends = np.cumsum(hi - lo)
+            cut = 0
+            while cut < len(probes):
+                stop = max(int(np.searchsorted(ends, (ends[cut - 1] if cut else 0) + max_candidates, side="right")), cut + 1)
+                positions, owners = _expand_ranges(lo[cut:stop], hi[cut:stop])
+                yield (owners + cut) // len(masks), self.orders[m][positions]
+                cut = stop
+
+    def query_many(self, values, radius, max_candidates=1 << 22):
+
+        # Range query for a block of values at once: (k, j, distance) for every record j within
+        # radius of values[k]
+        values = np.asarray(values, dtype=np.uint64)
+        found = list(self._probe(values, radius, max_candidates))
+        if not found:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint8)
+        k = np.concatenate([k for k, _ in found])
+        j = np.concatenate([j for _, j in found]).astype(np.int64)
+        distances = hamming_distance(values[k], self.values[j])
+        within = distances <= radius
+        keys, first = np.unique(k[within] * len(self.values) + j[within], return_index=True)
+        k, j = np.divmod(keys, len(self.values))
+        return k, j, distances[within][first]
+
+    def pairs(self, radius, block_size=4096, max_candidates=1 << 22):
+
+        # Yields (i, j, distance) arrays for every pair i < j within radius, one block at a time
+        for start in range(0, len(self.values), block_size):
+            rows = np.arange(start, min(start + block_size, len(self.values)))
+            found_i = []
+            found_j = []
+            for owners, j in self._probe(self.values[rows], radius, max_candidates):
+                i = rows[owners]
+                keep = i < j
+                found_i.append(i[keep])
+                found_j.append(j[keep])
+            i = np.concatenate(found_i)
+            j = np.concatenate(found_j)
+            distances = hamming_distance(self.values[i], self.values[j])
+            within = distances <= radius
+            if not within.any():
+                continue
+            # A pair close on several substrings is found once per substring; keep one copy
+            keys, first = np.unique(i[within].astype(np.int64) * len(self.values) + j[within], return_index=True)
+            i, j = np.divmod(keys, len(self.values))
+            yield i, j, distances[within][first]
+
+class UnionFind:
+    def __init__(self, size):
+
+        self.parent = list(range(size))
+
+    def find(self, x):
+
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+
+        # The smaller index always becomes the root, so groups do not depend on merge order
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    def roots(self):
+
+        return np.array([self.find(x) for x in range(len(self.parent))], dtype=np.int64)
+
+def _compare_tile(matrix, thresholds, row_start, row_end, col_start, col_end):
+
+    # Distances for one rows x cols tile, one hash type at a time so the working set stays small
+    rows = matrix[row_start:row_end]
+    cols = matrix[col_start:col_end]
+    distances = np.stack([popcount64(rows[:, None, t] ^ cols[None, :, t]) for t in range(matrix.shape[1])], axis=-1)
+    matched = (distances <= thresholds).any(axis=-1)
+    if row_start == col_start:
+        matched = np.triu(matched, 1)
+    i, j = np.nonzero(matched)
+    return i + row_start, j + col_start, distances[i, j]
+
+def all_pairs(matrix, thresholds, tile_size=512, max_workers=None):
+
+    # Exhaustive comparison of every record against every other, tile by tile. Yields
+    # (i, j, per-type distances) for pairs where at least one hash type is within its
+    # threshold, so memory depends on the tile size and never on n x n.
+    matrix = np.ascontiguousarray(matrix, dtype=np.uint64)
+    thresholds = np.asarray(thresholds, dtype=np.uint8)
+    count = len(matrix)
+    tiles = ((row_start, min(row_start + tile_size, count), col_start, min(col_start + tile_size, count))
+             for row_start in range(0, count, tile_size)
+             for col_start in range(row_start, count, tile_size))
+    max_workers = max_workers or os.cpu_count() or 1
+    # NumPy releases the GIL inside the XOR/popcount kernels, so threads spread tiles over cores
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque(executor.submit(_compare_tile, matrix, thresholds, *tile)
+                        for _, tile in zip(range(max_workers * 2), tiles))
+        while pending:
+            i, j, distances = pending.popleft().result()
+            tile = next(tiles, None)
+            if tile is not None:
+                pending.append(executor.submit(_compare_tile, matrix, thresholds, *tile))
+            if len(i):
+                yield i, j, distances
+
+def _compare_rows(matrix, rows, thresholds, col_start, col_end):
+
+    # _compare_tile for an arbitrary set of rows against one range of columns
+    selected = matrix[rows]
+    cols = matrix[col_start:col_end]
+    distances = np.stack([popcount64(selected[:, None, t] ^ cols[None, :, t]) for t in range(matrix.shape[1])], axis=-1)
+    i, j = np.nonzero((distances <= thresholds).any(axis=-1))
+    return rows[i], j + col_start
+
+def rows_against_all(matrix, rows, thresholds, executor, max_workers, first_col=0, tile_size=512):
+
+    # Exhaustive comparison of the given rows against every record from first_col on, tile by tile
+    # on the executor. Yields (row, column) arrays for pairs where at least one hash type is within
+    # its threshold.
+    thresholds = np.asarray(thresholds, dtype=np.uint8)
+    tiles = ((rows[row_start:row_start + tile_size], col_start, min(col_start + tile_size, len(matrix)))
+             for row_start in range(0, len(rows), tile_size)
+             for col_start in range(first_col, len(matrix), tile_size))
+    pending = deque(executor.submit(_compare_rows, matrix, tile_rows, thresholds, col_start, col_end)
+                    for _, (tile_rows, col_start, col_end) in zip(range(max_workers * 2), tiles))
+    while pending:
+        i, j = pending.popleft().result()
+        tile = next(tiles, None)
+        if tile is not None:
+            pending.append(executor.submit(_compare_rows, matrix, tile[0], thresholds, tile[1], tile[2]))
+        if len(i):
+            yield i, j
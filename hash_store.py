@@ -0,0 +1,409 @@
+import heapq
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+from collections.abc import Mapping
+import numpy as np
+
+HASH_TYPES = ("PHash", "DHash", "WHash", "AHash")
+STORE_MAGIC = b"IPHS"
+STORE_VERSION = 2
+# Versions this reader understands; version 1 has no presence column, every hash is present
+READABLE_VERSIONS = (1, 2)
+# magic, version, reserved, record count, metadata length
+STORE_HEADER = struct.Struct("<4sHHQI")
+# path length, payload length of a record spilled by SortedRecords
+RUN_RECORD_HEADER = struct.Struct("<II")
+# Bytes read from a spilled run at a time while the runs are merged
+RUN_READ_SIZE = 65536
+
+def hash_to_int(hash_value):
+
+    return int(hash_value, 16)
+
+def int_to_hash(value):
+
+    return format(int(value), "016x")
+
+def _aligned(offset):
+
+    return (offset + 7) & ~7
+
+def _split_path(image_path):
+
+    # Keep the exact prefix string so paths round-trip unchanged on every platform
+    name = os.path.basename(image_path)
+    return image_path[:len(image_path) - len(name)], name
+
+# Records keyed by path, kept in path order in bounded memory: up to `run_size` are held at a
+# time, each full run is sorted and spilled to a temporary file, and iterating merges the runs.
+# Writers go through this so a file's record order never depends on the order hashing finished.
+class SortedRecords:
+    def __init__(self, spool_dir, run_size):
+
+        self.spool_dir = spool_dir
+        self.run_size = run_size
+        self.records = []
+        self.runs = []
+        self.spool = None
+
+    def add(self, path, payload):
+
+        self.records.append((path, payload))
+        if len(self.records) >= self.run_size:
+            self._spill()
+
+    def _spill(self):
+
+        if self.spool is None:
+            self.spool = tempfile.TemporaryFile(dir=self.spool_dir)
+        self.records.sort(key=lambda record: record[0])
+        start = self.spool.seek(0, os.SEEK_END)
+        chunks = []
+        for path, payload in self.records:
+            path = path.encode("utf-8")
+            chunks += (RUN_RECORD_HEADER.pack(len(path), len(payload)), path, payload)
+        self.spool.write(b"".join(chunks))
+        self.runs.append((start, self.spool.tell()))
+        self.records = []
+
+    def _fill(self, pending, offset, position, end, size):
+
+        # Drops the consumed bytes and reads on until `size` unconsumed bytes are buffered
+        if len(pending) - offset >= size or position >= end:
+            return pending, offset, position
+        self.spool.seek(position)
+        chunk = self.spool.read(min(max(RUN_READ_SIZE, size), end - position))
+        return pending[offset:] + chunk, 0, position + len(chunk)
+
+    def _read_run(self, start, end):
+
+        pending, offset, position = b"", 0, start
+        while True:
+            pending, offset, position = self._fill(pending, offset, position, end, RUN_RECORD_HEADER.size)
+            if offset == len(pending):
+                return
+            path_size, payload_size = RUN_RECORD_HEADER.unpack_from(pending, offset)
+            record_size = RUN_RECORD_HEADER.size + path_size + payload_size
+            pending, offset, position = self._fill(pending, offset, position, end, record_size)
+            path_start = offset + RUN_RECORD_HEADER.size
+            yield (pending[path_start:path_start + path_size].decode("utf-8"),
+                   pending[path_start + path_size:offset + record_size])
+            offset += record_size
+
+    def __iter__(self):
+
+        if not self.runs:
+            self.records.sort(key=lambda record: record[0])
+            return iter(self.records)
+        if self.records:
+            self._spill()
+        return heapq.merge(*(self._read_run(start, end) for start, end in self.runs), key=lambda record: record[0])
+
+    def close(self):
+
+        self.records = []
+        if self.spool is not None:
+            self.spool.close()
+
+class HashStoreWriter:
+    def __init__(self, store_path, hash_types=HASH_TYPES, metadata=None, buffer_size=65536):
+
+        self.store_path = store_path
+        self.hash_types = tuple(hash_types)
+        self.metadata = dict(metadata or {})
+        self.buffer_size = buffer_size
+        self.count = 0
+        self.names_size = 0
+        self.dir_ids = {}
+        # Presence mask and hash values of one record, as SortedRecords holds it
+        self.record_struct = struct.Struct(f"<B{len(self.hash_types)}Q")
+        self.record_dtype = np.dtype([("present", "u1")] + [(hash_type, "<u8") for hash_type in self.hash_types])
+        spool_dir = os.path.dirname(os.path.abspath(store_path))
+        self.records = SortedRecords(spool_dir, buffer_size)
+        # In path order, records are then buffered and spilled to temporary files per column, so
+        # memory stays bounded however many images are written; close() stitches the final layout together
+        self.rows = bytearray()
+        self.buffers = {"dir_index": array("I"), "name_ends": array("Q"), "names": bytearray()}
+        self.spools = {key: tempfile.TemporaryFile(dir=spool_dir)
+                       for key in self.hash_types + ("present", "dir_index", "name_ends", "names")}
+
+    def write(self, image_path, hashes):
+
+        # Missing hashes are stored as 0 with their bit cleared in the presence mask
+        present = 0
+        values = []
+        for bit, hash_type in enumerate(self.hash_types):
+            if hash_type in hashes:
+                present |= 1 << bit
+                values.append(hash_to_int(hashes[hash_type]))
+            else:
+                values.append(0)
+        self.records.add(image_path, self.record_struct.pack(present, *values))
+        self.count += 1
+
+    def _append(self, image_path, record):
+
+        directory, name = _split_path(image_path)
+        name = name.encode("utf-8")
+        self.buffers["dir_index"].append(self.dir_ids.setdefault(directory, len(self.dir_ids)))
+        self.names_size += len(name)
+        self.buffers["name_ends"].append(self.names_size)
+        self.buffers["names"] += name
+        self.rows += record
+        if len(self.buffers["dir_index"]) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+
+        # The on-disk format is little-endian regardless of the host
+        rows = np.frombuffer(self.rows, dtype=self.record_dtype)
+        for key in self.hash_types + ("present",):
+            self.spools[key].write(np.ascontiguousarray(rows[key]).tobytes())
+        del rows
+        self.rows = bytearray()
+        for key, buffer in self.buffers.items():
+            if isinstance(buffer, array):
+                buffer = np.asarray(buffer, dtype="<u8" if buffer.typecode == "Q" else "<u4").tobytes()
+            self.spools[key].write(buffer)
+            del self.buffers[key][:]
+
+    def close(self):
+
+        for image_path, record in self.records:
+            self._append(image_path, record)
+        self.records.close()
+        self.flush()
+        dirs = [directory.encode("utf-8") for directory in self.dir_ids]
+        metadata = dict(self.metadata, hash_types=list(self.hash_types), dir_count=len(dirs))
+        meta_bytes = json.dumps(metadata, ensure_ascii=False).encode("utf-8")
+
+        temp_path = self.store_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, 0, self.count, len(meta_bytes)))
+            f.write(meta_bytes)
+            f.write(b"\0" * (_aligned(f.tell()) - f.tell()))
+            for key in self.hash_types + ("dir_index", "present"):
+                self._copy_spool(key, f)
+            f.write(b"\0" * (_aligned(f.tell()) - f.tell()))
+            f.write(np.zeros(1, dtype="<u8").tobytes())
+            self._copy_spool("name_ends", f)
+            f.write(np.cumsum([0] + [len(directory) for directory in dirs], dtype="<u8").tobytes())
+            self._copy_spool("names", f)
+            f.write(b"".join(dirs))
+            f.flush()
+            os.fsync(f.fileno())
+        self._discard_spools()
+        os.replace(temp_path, self.store_path)
+
+    def _copy_spool(self, key, f):
+
+        spool = self.spools[key]
+        spool.seek(0)
+        shutil.copyfileobj(spool, f)
+
+    def _discard_spools(self):
+
+        self.records.close()
+        for spool in self.spools.values():
+            spool.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        # On failure the previous store is left untouched
+        if exc_type is None:
+            self.close()
+        else:
+            self._discard_spools()
+
+class TextHashWriter:
+    def __init__(self, result_file_path, hash_types=HASH_TYPES, metadata=None, buffer_size=65536):
+
+        self.result_file_path = result_file_path
+        self.hash_types = tuple(hash_types)
+        self.records = SortedRecords(os.path.dirname(os.path.abspath(result_file_path)), buffer_size)
+
+    def write(self, image_path, hashes):
+
+        self.records.add(image_path, (f"Image: {image_path}\n" + "\n".join(
+            f"{k}: {hashes[k]}" for k in self.hash_types if k in hashes
+        ) + "\n\n").encode("utf-8"))
+
+    def close(self):
+
+        with open(self.result_file_path + ".tmp", 'w', encoding='utf-8') as result_file:
+            for _, record in self.records:
+                result_file.write(record.decode("utf-8"))
+        self.records.close()
+        os.replace(self.result_file_path + ".tmp", self.result_file_path)
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if exc_type is None:
+            self.close()
+        else:
+            self.records.close()
+
+class HashStore(Mapping):
+    def __init__(self, store_path):
+
+        self.store_path = store_path
+        with open(store_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < STORE_HEADER.size:
+                raise ValueError(f"Not a hash store (too short): {store_path}")
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, count, meta_length = STORE_HEADER.unpack_from(self.buffer, 0)
+        if magic != STORE_MAGIC or version not in READABLE_VERSIONS:
+            raise ValueError(f"Not a hash store (or unsupported version): {store_path}")
+        try:
+            offset = STORE_HEADER.size
+            self.metadata = json.loads(bytes(self.buffer[offset:offset + meta_length]).decode("utf-8"))
+            offset = _aligned(offset + meta_length)
+
+            self.count = count
+            self.hash_types = tuple(self.metadata["hash_types"])
+            # Tiers in the order they were computed; later tiers may only exist for some records
+            self.hash_tiers = tuple(tuple(tier) for tier in self.metadata.get("hash_tiers", [self.hash_types]))
+            # Zero-copy views straight onto the mapped file
+            self.columns = {}
+            for hash_type in self.hash_types:
+                self.columns[hash_type] = np.frombuffer(self.buffer, dtype="<u8", count=count, offset=offset)
+                offset += count * 8
+            self.dir_index = np.frombuffer(self.buffer, dtype="<u4", count=count, offset=offset)
+            offset += count * 4
+            if version >= 2:
+                self.present = np.frombuffer(self.buffer, dtype="u1", count=count, offset=offset)
+                offset += count
+            else:
+                self.present = np.full(count, (1 << len(self.hash_types)) - 1, dtype="u1")
+            offset = _aligned(offset)
+            dir_count = self.metadata["dir_count"]
+            self.name_offsets = np.frombuffer(self.buffer, dtype="<u8", count=count + 1, offset=offset)
+            offset += (count + 1) * 8
+            self.dir_offsets = np.frombuffer(self.buffer, dtype="<u8", count=dir_count + 1, offset=offset)
+            offset += (dir_count + 1) * 8
+            self.names_offset = offset
+            self.dirs_offset = offset + int(self.name_offsets[-1])
+            self.dirs = [self._read_blob(self.dirs_offset, self.dir_offsets, i) for i in range(dir_count)]
+        except (KeyError, ValueError) as e:
+            # Truncated or damaged files fail here rather than on the first record read
+            raise ValueError(f"Corrupt hash store {store_path}: {e}") from e
+        self.path_index = None
+
+    def _read_blob(self, base, offsets, i):
+
+        return self.buffer[base + int(offsets[i]):base + int(offsets[i + 1])].decode("utf-8")
+
+    def path(self, i):
+
+        return self.dirs[self.dir_index[i]] + self._read_blob(self.names_offset, self.name_offsets, i)
+
+    def paths(self):
+
+        return [self.path(i) for i in range(self.count)]
+
+    def index_of(self, image_path):
+
+        if self.path_index is None:
+            self.path_index = {image_path: i for i, image_path in enumerate(self.paths())}
+        return self.path_index[image_path]
+
+    def hashes(self, i):
+
+        present = int(self.present[i])
+        return {hash_type: int_to_hash(self.columns[hash_type][i])
+                for bit, hash_type in enumerate(self.hash_types) if present >> bit & 1}
+
+    def matrix(self):
+
+        # (count, hash types) copy for code that wants every hash of a record together
+        return np.stack([self.columns[hash_type] for hash_type in self.hash_types], axis=1)
+
+    def presence(self, indices=None):
+
+        # (records, hash types) booleans matching matrix(): which hashes each record really has
+        present = self.present if indices is None else self.present[indices]
+        return (present[:, None] >> np.arange(len(self.hash_types), dtype="u1")) & 1 == 1
+
+    def __getitem__(self, image_path):
+
+        return self.hashes(self.index_of(image_path))
+
+    def __iter__(self):
+
+        return (self.path(i) for i in range(self.count))
+
+    def __len__(self):
+
+        return self.count
+
+    def close(self):
+
+        self.columns = {}
+        self.dir_index = self.present = self.name_offsets = self.dir_offsets = None
+        try:
+            self.buffer.close()
+        except BufferError:
+            # Views handed out to callers are still alive; the map is released when they are
+            pass
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.close()
+
+def open_hash_writer(result_file_path, hash_types=HASH_TYPES, metadata=None):
+
+    if result_file_path.lower().endswith(".txt"):
+        return TextHashWriter(result_file_path, hash_types, metadata)
+    return HashStoreWriter(result_file_path, hash_types, metadata)
+
+def read_text_hashes(text_file_path):
+
+    current_image = None
+    hashes = {}
+    with open(text_file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("Image: "):
+                if current_image is not None:
+                    yield current_image, hashes
+                current_image = line[7:]
+                hashes = {}
+            elif line:
+                hash_type, hash_value = line.split(": ")
+                hashes[hash_type] = hash_value
+    if current_image is not None:
+        yield current_image, hashes
+
+def import_text_hashes(text_file_path, store_path):
+
+    count = 0
+    with HashStoreWriter(store_path) as writer:
+        for image_path, hashes in read_text_hashes(text_file_path):
+            writer.write(image_path, hashes)
+            count += 1
+    return count
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python hash_store.py <image_hashes.txt> <image_hashes.bin>")
+        sys.exit(2)
+    imported = import_text_hashes(sys.argv[1], sys.argv[2])
+    print(f"Imported {imported} images into {sys.argv[2]}")
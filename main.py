@@ -1,10 +1,21 @@
-import tkinter as tk
-from ui import ImageDeduplicatorUI
-from calculation import HashCalculator, DuplicateAnalyzer
+import multiprocessing
+import sys
+
+def run_gui():
+    import tkinter as tk
+    from ui import ImageDeduplicatorUI
+    from calculation import HashCalculator, DuplicateAnalyzer
 
-if __name__ == "__main__":
     root = tk.Tk()
     hash_calculator = HashCalculator()
     duplicate_analyzer = DuplicateAnalyzer()
     app = ImageDeduplicatorUI(root, hash_calculator, duplicate_analyzer)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    # Any command-line arguments select the headless CLI, which never loads Tk
+    if len(sys.argv) > 1:
+        from cli import main
+        sys.exit(main())
+    run_gui()
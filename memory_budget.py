@@ -0,0 +1,61 @@
+import ctypes
+import multiprocessing
+import sys
+import threading
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+def decoded_size(img):
+
+    # Bytes the decoded image takes, plus the 8-bit grey copy hashing converts it to;
+    # read from the header, so nothing has been decoded yet
+    width, height = img.size
+    return width * height * (len(img.getbands()) + 1)
+
+def pin_mmap_threshold(threshold=1 << 20):
+
+    # glibc raises its mmap threshold after large frees, so decode buffers freed by one thread
+    # stay in that thread's arena and RSS creeps up to the sum of every worker's biggest image.
+    # A fixed threshold keeps large buffers on mmap, which hands them back to the OS on free.
+    if sys.platform.startswith("linux"):
+        try:
+            ctypes.CDLL("libc.so.6").mallopt(-3, threshold)  # M_MMAP_THRESHOLD
+        except (OSError, AttributeError):
+            pass
+
+# Caps the memory of decodes running at the same time. Workers reserve an image's decoded
+# size before decoding it and wait while the budget is taken. An image larger than the whole
+# budget is still decoded, but only once nothing else is running.
+class MemoryBudget:
+    def __init__(self, limit, condition=None, used=None):
+
+        self.limit = limit
+        self.condition = condition if condition is not None else threading.Condition()
+        # Not `used or ...`: a shared RawValue holding 0 is falsy
+        self.used = used if used is not None else SimpleNamespace(value=0)
+
+    @classmethod
+    def shared(cls, limit):
+
+        # For process pools: the counter lives in shared memory and the condition spans processes.
+        # Pass it to the workers when they start, e.g. through the pool initializer.
+        return cls(limit, multiprocessing.Condition(), multiprocessing.RawValue("q", 0))
+
+    def oversized(self, amount):
+
+        return amount > self.limit
+
+    @contextmanager
+    def reserve(self, amount):
+
+        amount = min(amount, self.limit)
+        with self.condition:
+            while self.used.value and self.used.value + amount > self.limit:
+                self.condition.wait()
+            self.used.value += amount
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.used.value -= amount
+                self.condition.notify_all()
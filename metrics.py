@@ -0,0 +1,120 @@
+import cProfile
+import io
+import json
+import pstats
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+class StageTimer:
+    def __init__(self):
+
+        self.stages = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds, calls=1):
+
+        total = self.stages.setdefault(name, [0.0, 0])
+        total[0] += seconds
+        total[1] += calls
+
+    def count(self, name, amount=1):
+
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def merge(self, other):
+
+        # Accepts another timer or its as_dict() form, which is what worker processes send back
+        if isinstance(other, StageTimer):
+            other = other.as_dict()
+        for name, (seconds, calls) in other["stages"].items():
+            self.add(name, seconds, calls)
+        for name, amount in other["counters"].items():
+            self.count(name, amount)
+
+    def as_dict(self):
+
+        return {"stages": {name: list(total) for name, total in self.stages.items()}, "counters": dict(self.counters)}
+
+class PipelineMetrics:
+    def __init__(self, name, metrics_callback=None, summary_path=None, profile=False):
+
+        self.name = name
+        self.metrics_callback = metrics_callback
+        self.summary_path = summary_path
+        self.profile = profile
+        self.timer = StageTimer()
+        self.total = 0
+        self.completed = 0
+        self.start_time = None
+        self.profiler = None
+
+    def start(self, total=0):
+
+        self.total = total
+        self.start_time = time.perf_counter()
+        if self.profile:
+            # cProfile only sees the calling thread; worker time still shows up in the stage timings
+            self.profiler = cProfile.Profile()
+            tracemalloc.start()
+            self.profiler.enable()
+
+    def stage(self, name):
+
+        return self.timer.stage(name)
+
+    def advance(self, completed=1):
+
+        self.completed += completed
+
+    def snapshot(self):
+
+        elapsed = time.perf_counter() - self.start_time if self.start_time is not None else 0.0
+        throughput = self.completed / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.total - self.completed, 0)
+        return {
+            "pipeline": self.name,
+            "elapsed_s": elapsed,
+            "completed": self.completed,
+            "total": self.total,
+            "throughput_per_s": throughput,
+            "eta_s": remaining / throughput if throughput > 0 else None,
+            "stages": {name: {"seconds": seconds, "calls": calls}
+                       for name, (seconds, calls) in self.timer.stages.items()},
+            "counters": dict(self.timer.counters),
+        }
+
+    def report(self):
+
+        if self.metrics_callback is not None:
+            self.metrics_callback(self.snapshot())
+
+    def finish(self):
+
+        summary = self.snapshot()
+        if self.profiler is not None:
+            self.profiler.disable()
+            stream = io.StringIO()
+            pstats.Stats(self.profiler, stream=stream).sort_stats("cumulative").print_stats(25)
+            _, peak = tracemalloc.get_traced_memory()
+            top_allocations = tracemalloc.take_snapshot().statistics("lineno")[:10]
+            tracemalloc.stop()
+            summary["profile"] = stream.getvalue()
+            summary["tracemalloc_peak_bytes"] = peak
+            summary["tracemalloc_top"] = [str(statistic) for statistic in top_allocations]
+            self.profiler = None
+        if self.summary_path:
+            with open(self.summary_path, "w", encoding="utf-8") as f:
+                json.dump(summary, f, indent=2)
+        if self.metrics_callback is not None:
+            self.metrics_callback(summary)
+        return summary
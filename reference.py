@@ -0,0 +1,139 @@
+import json
+import os
+import numpy as np
+from hash_index import MultiIndexHash, hamming_distance, tier_matches
+from hash_store import HashStore, hash_to_int
+
+INDEX_VERSION = 1
+INDEX_META_FILE = "index.json"
+
+def store_signature(store_path):
+
+    stat_result = os.stat(store_path)
+    return [stat_result.st_size, stat_result.st_mtime_ns]
+
+# A persistent multi-index over a hash store, so new images can be checked against a large
+# library without rehashing it or re-comparing it with itself. The substring tables are saved
+# next to the store and memory-mapped, so opening the index costs about the same as opening
+# the store; they are rebuilt only when the store changes.
+class ReferenceIndex:
+    def __init__(self, store_path, index_dir=None):
+
+        self.store_path = store_path
+        self.index_dir = index_dir or store_path + ".idx"
+        self.signature = None
+        self.store = None
+        self.indexes = {}
+
+    def _table_prefix(self, hash_type):
+
+        return os.path.join(self.index_dir, hash_type)
+
+    def _meta_path(self):
+
+        return os.path.join(self.index_dir, INDEX_META_FILE)
+
+    def _read_meta(self):
+
+        try:
+            with open(self._meta_path(), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_current(self, store=None):
+
+        meta = self._read_meta()
+        return (meta is not None and meta.get("version") == INDEX_VERSION
+                and meta.get("store_signature") == store_signature(self.store_path)
+                and (store is None or meta.get("hash_types") == list(store.hash_types)))
+
+    def build(self, store=None):
+
+        own_store = store is None
+        store = store or HashStore(self.store_path)
+        try:
+            os.makedirs(self.index_dir, exist_ok=True)
+            # The metadata is written last, so an interrupted build is simply seen as stale
+            if os.path.exists(self._meta_path()):
+                os.remove(self._meta_path())
+            for hash_type in store.hash_types:
+                MultiIndexHash(store.columns[hash_type]).save(self._table_prefix(hash_type))
+            meta = {
+                "version": INDEX_VERSION,
+                "store_signature": store_signature(self.store_path),
+                "hash_types": list(store.hash_types),
+                "count": len(store),
+            }
+            temp_path = self._meta_path() + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.replace(temp_path, self._meta_path())
+        finally:
+            if own_store:
+                store.close()
+
+    def open(self):
+
+        # Cheap when nothing changed; picks up a store rewritten by a later indexing run
+        signature = store_signature(self.store_path)
+        if signature == self.signature:
+            return self
+        self.close()
+        store = HashStore(self.store_path)
+        if not self.is_current(store):
+            self.build(store)
+        if len(store):
+            self.indexes = {hash_type: MultiIndexHash.load(store.columns[hash_type], self._table_prefix(hash_type))
+                            for hash_type in store.hash_types}
+        else:
+            # Empty arrays cannot be memory-mapped
+            self.indexes = {hash_type: MultiIndexHash(store.columns[hash_type]) for hash_type in store.hash_types}
+        self.store = store
+        self.signature = signature
+        return self
+
+    def query(self, hashes, thresholds):
+
+        # Records that match the given hashes under the store's tiers, closest first. Candidates
+        # come from the first tier's indexes; hashes either side lacks are left out of the comparison.
+        self.open()
+        hash_types = self.store.hash_types
+        tiers = [[hash_types.index(hash_type) for hash_type in tier] for tier in self.store.hash_tiers]
+        values = {hash_type: np.uint64(hash_to_int(hashes[hash_type])) for hash_type in hash_types if hash_type in hashes}
+        found = [self.indexes[hash_types[t]].query(values[hash_types[t]], thresholds.get(hash_types[t], 0))[0]
+                 for t in tiers[0] if hash_types[t] in values]
+        candidates = np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int64)
+        distances = np.stack([hamming_distance(self.store.columns[hash_type][candidates], values.get(hash_type, np.uint64(0)))
+                              for hash_type in hash_types], axis=1)
+        comparable = self.store.presence(candidates) & np.array([hash_type in values for hash_type in hash_types])
+        limits = np.array([thresholds.get(hash_type, 0) for hash_type in hash_types])
+        matched = tier_matches(distances, comparable, limits, tiers)
+        matches = []
+        for k in np.flatnonzero(matched).tolist():
+            i = int(candidates[k])
+            match_distances = {hash_type: int(distances[k, t]) for t, hash_type in enumerate(hash_types) if comparable[k, t]}
+            matches.append({
+                "path": self.store.path(i),
+                "hashes": self.store.hashes(i),
+                "distances": match_distances,
+                "duplicate": not any(match_distances.values())
+            })
+        matches.sort(key=lambda match: sum(match["distances"].values()))
+        return matches
+
+    def close(self):
+
+        self.indexes = {}
+        self.signature = None
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def __enter__(self):
+
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.close()
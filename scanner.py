@@ -0,0 +1,59 @@
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Extensions picked up by a folder scan; every one of them has a matching header sniff
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".heic", ".heif")
+
+def _scan_directory(directory, extensions):
+
+    files = []
+    subdirectories = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif entry.name.lower().endswith(extensions) and entry.is_file():
+                        # DirEntry caches the stat result, so nothing stats the file again later
+                        files.append((entry.path, entry.stat()))
+                except OSError as e:
+                    print(f"Error reading file info for {entry.path}: {e}", file=sys.stderr)
+    except OSError as e:
+        print(f"Error scanning {directory}: {e}", file=sys.stderr)
+    files.sort()
+    return files, subdirectories
+
+def _list_directory(directory, extensions):
+
+    # The mtime is read before listing, so a change made while listing shows up on the next comparison
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except OSError:
+        return directory, None, [], []
+    files, subdirectories = _scan_directory(directory, extensions)
+    return directory, mtime, files, subdirectories
+
+def walk_directories(directories, extensions=IMAGE_EXTENSIONS, max_workers=8, recurse=True):
+
+    # Yields (directory, mtime_ns, files, subdirectories) for each directory as soon as it is listed;
+    # mtime_ns is None for a directory that no longer exists. Directories are listed in parallel,
+    # which hides the per-request latency of network mounts.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(_list_directory, directory, extensions) for directory in directories}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                listing = future.result()
+                if recurse:
+                    pending.update(executor.submit(_list_directory, subdirectory, extensions)
+                                   for subdirectory in listing[3])
+                yield listing
+
+def scan_images(folder_path, extensions=IMAGE_EXTENSIONS, max_workers=8):
+
+    # Yields the (path, stat_result) pairs of one directory at a time, as soon as it is listed
+    for _, _, files, _ in walk_directories([folder_path], extensions, max_workers):
+        if files:
+            yield files
@@ -0,0 +1,60 @@
+import os
+import zlib
+from hash_store import HashStore, HashStoreWriter
+
+def relative_image_path(image_path, root_path):
+
+    # Forward slashes, so shards written on different platforms merge into the same paths
+    return os.path.relpath(image_path, root_path).replace(os.sep, "/")
+
+def shard_of(relative_path, shard_count):
+
+    # crc32 rather than hash(): the split must be identical on every machine and interpreter
+    return zlib.crc32(relative_path.encode("utf-8")) % shard_count
+
+def shard_metadata(root_id, shard_id, shard_count):
+
+    return {"root_id": root_id, "shard_id": shard_id, "shard_count": shard_count, "relative_paths": True}
+
+def _check_shards(stores):
+
+    first = stores[0].metadata
+    if "root_id" not in first:
+        raise ValueError(f"Not a shard file: {stores[0].store_path}")
+    seen = set()
+    for store in stores:
+        meta = store.metadata
+        # A merged store carries the root_id of its run but no shard_id
+        if meta.get("shard_id") is None:
+            raise ValueError(f"Not a shard file: {store.store_path}")
+        if meta.get("root_id") != first["root_id"] or meta.get("shard_count") != first["shard_count"]:
+            raise ValueError(f"{store.store_path} belongs to a different sharded run "
+                             f"({meta.get('root_id')}, {meta.get('shard_count')} shards)")
+        if store.hash_types != stores[0].hash_types:
+            raise ValueError(f"{store.store_path} holds different hash types: {store.hash_types}")
+        if meta["shard_id"] in seen:
+            raise ValueError(f"Shard {meta['shard_id']} given twice")
+        seen.add(meta["shard_id"])
+    return sorted(set(range(first["shard_count"])) - seen)
+
+def merge_shards(shard_paths, output_path, root_path=None, allow_missing=False):
+
+    # Combines shard files of one run into a single store. With root_path the relative paths
+    # are resolved against this machine's copy of the archive so the images can be opened here.
+    stores = [HashStore(shard_path) for shard_path in shard_paths]
+    try:
+        missing = _check_shards(stores)
+        if missing and not allow_missing:
+            raise ValueError(f"Missing shards: {', '.join(map(str, missing))}")
+        root_id = stores[0].metadata["root_id"]
+        records = sorted((store.path(i), s, i) for s, store in enumerate(stores) for i in range(len(store)))
+        metadata = {"root_id": root_id, "shard_count": stores[0].metadata["shard_count"],
+                    "merged_shards": len(stores), "relative_paths": root_path is None}
+        with HashStoreWriter(output_path, stores[0].hash_types, metadata) as writer:
+            for relative_path, s, i in records:
+                image_path = relative_path if root_path is None else os.path.join(root_path, *relative_path.split("/"))
+                writer.write(image_path, stores[s].hashes(i))
+        return len(records), missing
+    finally:
+        for store in stores:
+            store.close()
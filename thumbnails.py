@@ -0,0 +1,55 @@
+import os
+import threading
+from PIL import Image
+from calculation import load_thumbnail
+from file_digest import full_digest
+
+THUMBNAIL_CACHE_DIR = "image_thumbnails"
+THUMBNAIL_SIZE = (150, 150)
+
+# Thumbnails on disk keyed by file content, so renamed or copied images reuse them and
+# edited ones never show a stale picture. get() is safe to call from several threads.
+class ThumbnailCache:
+    def __init__(self, cache_dir=THUMBNAIL_CACHE_DIR, size=THUMBNAIL_SIZE):
+
+        self.cache_dir = cache_dir
+        self.size = size
+        self.keys = {}
+        self.lock = threading.Lock()
+
+    def cache_path(self, key):
+
+        return os.path.join(self.cache_dir, key[:2], f"{key}_{self.size[0]}x{self.size[1]}.png")
+
+    def _key(self, image_path):
+
+        # Reading the file is far cheaper than decoding it, and the digest is remembered per file version
+        stat_result = os.stat(image_path)
+        signature = (image_path, stat_result.st_size, stat_result.st_mtime_ns)
+        with self.lock:
+            key = self.keys.get(signature)
+        if key is None:
+            key = full_digest(image_path)
+            with self.lock:
+                self.keys[signature] = key
+        return key
+
+    def get(self, image_path):
+
+        cache_path = self.cache_path(self._key(image_path))
+        try:
+            with Image.open(cache_path) as cached:
+                return cached.copy()
+        except (OSError, ValueError):
+            pass
+        thumbnail = load_thumbnail(image_path, self.size)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+        try:
+            thumbnail.save(temp_path, "PNG")
+            os.replace(temp_path, cache_path)
+        except OSError:
+            # A read-only or full disk only costs the cache, not the thumbnail
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return thumbnail
@@ -1,23 +1,48 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, Canvas, Toplevel
-from PIL import Image, ImageTk
 from collections import OrderedDict
 import time
 import sys
 import os
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from calculation import open_image
+from events import EventBus, format_duration
+from scanner import IMAGE_EXTENSIONS
+from thumbnails import ThumbnailCache, THUMBNAIL_SIZE
+from watcher import FolderWatcher
 
 LANGUAGES = {
     "zh_CN": "zh_CN.lang",
     "en_US": "en_US.lang"
 }
 CURRENT_LANGUAGE = "zh_CN"
+# Every result group gets a fixed-height row so the visible groups follow from the scroll offset alone
+GROUP_ROW_HEIGHT = 430
+# Groups kept rendered above and below the viewport
+RENDER_MARGIN = 2
+# Seconds between handing freshly found groups to the view while the analysis runs
+RESULT_FLUSH_INTERVAL = 0.25
+# Lines the log display keeps; older ones are removed as new ones arrive
+MAX_LOG_LINES = 2000
+# Parsed .lang files, read once per language
+LANGUAGE_CATALOGS = {}
 
 def resource_path(relative_path):
     if hasattr(sys, '_MEIPASS'):
         return os.path.join(sys._MEIPASS, relative_path)
     return os.path.join(os.path.abspath("."), relative_path)
 
+def read_file_info(image_path):
+    # Runs on a worker thread; only the header is read for the dimensions
+    stat_result = os.stat(image_path)
+    try:
+        with open_image(image_path) as img:
+            dimensions = img.size
+    except Exception:
+        dimensions = None
+    return stat_result.st_size, stat_result.st_mtime, dimensions
+
 def load_language(lang):
     lang_dict = {}
     lang_file = LANGUAGES.get(lang)
@@ -32,6 +57,11 @@ def load_language(lang):
                         lang_dict[key.strip()] = value.strip()
     return lang_dict
 
+def get_language(lang):
+    if lang not in LANGUAGE_CATALOGS:
+        LANGUAGE_CATALOGS[lang] = load_language(lang)
+    return LANGUAGE_CATALOGS[lang]
+
 
 class ImageDeduplicatorUI:
     def __init__(self, root, hash_calculator, duplicate_analyzer):
@@ -49,14 +79,40 @@ class ImageDeduplicatorUI:
         self.style.configure("TLabelframe.Label", background="#f0f0f0", font=('Helvetica', 10))
 
         self.image_cache = OrderedDict()
-        self.MAX_CACHE_SIZE = 100
+        self.image_cache_bytes = 0
+        # Decoded thumbnails held in memory, counted as RGBA pixels
+        self.MAX_CACHE_BYTES = 64 * 1024 * 1024
+        self.thumbnail_cache = ThumbnailCache()
+        self.thumbnail_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        self.thumbnail_pending = {}
+        self.thumbnail_failed = set()
+        self.placeholder_image = None
+        # Worker threads only post to the bus; _pump_events applies it to the widgets once per frame
+        self.events = EventBus()
         self.hash_calculator = hash_calculator
+        self.hash_calculator.identical_callback = self._on_identical_files
+        self.hash_calculator.metrics_callback = self.events.metrics
         self.duplicate_analyzer = duplicate_analyzer
+        self.duplicate_analyzer.metrics_callback = self.events.metrics
         self.scroll_update_scheduled = False 
         self.scroll_delta = 0
+        self.hash_stats = None
+        self.result_groups = []
+        self.rendered_groups = {}
+        self.group_frame_pool = []
+        self.group_check_vars = {}
+        self.file_info = {}
+        self.file_info_pending = set()
+        self.file_info_executor = ThreadPoolExecutor(max_workers=4)
+        self.render_scheduled = False
+        self.content_width = 0
+        self.watcher = None
+        self.watch_groups = []
+        self.watch_hashes = {}
 
         self.create_main_layout()
         self._update_check_button_state()
+        self._pump_events()
 
     def create_main_layout(self):
         top_frame = ttk.Frame(self.root, padding=(10, 5))
@@ -109,10 +165,48 @@ class ImageDeduplicatorUI:
         )
         self.check_btn.pack(side=tk.LEFT, padx=5)
 
+        self.library_btn = ttk.Button(
+            button_frame,
+            text=self._get_lang_text("LIBRARY_BTN_TEXT", "Check new images against the library"),
+            command=self.start_library_check,
+            state=tk.DISABLED,
+            style="TButton"
+        )
+        self.library_btn.pack(side=tk.LEFT, padx=5)
+
+        self.cancel_btn = ttk.Button(
+            button_frame,
+            text=self._get_lang_text("CANCEL_BTN_TEXT", "Cancel hashing"),
+            command=self.cancel_hash_calculation,
+            state=tk.DISABLED,
+            style="TButton"
+        )
+        self.cancel_btn.pack(side=tk.LEFT, padx=5)
+
+        self.resume_btn = ttk.Button(
+            button_frame,
+            text=self._get_lang_text("RESUME_BTN_TEXT", "Resume hashing"),
+            command=self.resume_hash_calculation,
+            state=tk.DISABLED,
+            style="TButton"
+        )
+        self.resume_btn.pack(side=tk.LEFT, padx=5)
+
+        self.watch_btn = ttk.Button(
+            button_frame,
+            text=self._get_lang_text("WATCH_BTN_TEXT", "Watch a folder for new images"),
+            command=self.toggle_watch,
+            style="TButton"
+        )
+        self.watch_btn.pack(side=tk.LEFT, padx=5)
+
     def create_progress_bar(self, parent):
         progress_frame = ttk.Frame(parent)
         progress_frame.pack(fill=tk.X, pady=5)
 
+        self.status_label = ttk.Label(progress_frame, width=32, anchor=tk.E)
+        self.status_label.pack(side=tk.RIGHT, padx=5)
+
         self.progress_bar = ttk.Progressbar(
             progress_frame,
             orient=tk.HORIZONTAL,
@@ -138,48 +232,62 @@ class ImageDeduplicatorUI:
         h_scrollbar = ttk.Scrollbar(result_frame, orient=tk.HORIZONTAL)
         h_scrollbar.pack(side=tk.BOTTOM, fill=tk.X)
 
-        self.canvas = Canvas(result_frame, yscrollcommand=v_scrollbar.set, xscrollcommand=h_scrollbar.set, 
+        self.v_scrollbar = v_scrollbar
+        self.canvas = Canvas(result_frame, yscrollcommand=self._on_canvas_yview, xscrollcommand=h_scrollbar.set, 
                              bd=0, highlightthickness=0, bg="white")
-        self.result_frame = ttk.Frame(self.canvas)
-        self.canvas.create_window((0, 0), window=self.result_frame, anchor=tk.NW)
         self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
 
         v_scrollbar.config(command=self.canvas.yview)
         h_scrollbar.config(command=self.canvas.xview)
 
-        self.result_frame.bind("<Configure>", lambda e: self.canvas.configure(scrollregion=self.canvas.bbox("all")))
+        self.canvas.bind("<Configure>", lambda e: self._schedule_render())
         result_frame.bind_all("<MouseWheel>", self._on_mousewheel)
 
     def start_hash_calculation(self):
         folder_path = filedialog.askdirectory()
         if folder_path:
+            self._release_reference_index()
             self.log(self._get_lang_text("LOG_START_HASH_CALCULATION", "Start calculating hashes, folder path: {0}").format(folder_path))
             if self.hash_calculator.has_existing_hashes():
                 result = messagebox.askyesno(
                     self._get_lang_text("MSG_COMPLETE", "Default completion message"),
-                    self._get_lang_text("MSG_REGENERATE_HASH", "The hash value file already exists. Do you want to recalculate it?")
+                    self._get_lang_text("MSG_REGENERATE_HASH", "The hash value file already exists. Do you want to update it? Only new or changed images will be hashed.")
                 )
                 if result:
-                    self._toggle_buttons(False)
-                    self.show_progress()
-                    threading.Thread(
-                        target=self.hash_calculator.calculate_hashes,
-                        args=(folder_path, self._update_progress, self._on_hash_calculation_complete),
-                        daemon=True
-                    ).start()
+                    self._start_hashing(self.hash_calculator.calculate_hashes, folder_path)
                 else:
                     self.check_btn.config(state=tk.NORMAL)
+                    self.library_btn.config(state=tk.NORMAL)
             else:
-                self._toggle_buttons(False)
-                self.show_progress()
-                threading.Thread(
-                    target=self.hash_calculator.calculate_hashes,
-                    args=(folder_path, self._update_progress, self._on_hash_calculation_complete),
-                    daemon=True
-                ).start()
+                self._start_hashing(self.hash_calculator.calculate_hashes, folder_path)
         else:
             self.log(self._get_lang_text("LOG_NO_FOLDER_SELECTED", "Oops! You haven't selected a folder yet😔."))
 
+    def _start_hashing(self, target, *args):
+        self._toggle_buttons(False)
+        self.cancel_btn.config(state=tk.NORMAL)
+        self.show_progress()
+        threading.Thread(
+            target=target,
+            args=args + (self._update_progress, self._on_hash_calculation_complete),
+            daemon=True
+        ).start()
+
+    def cancel_hash_calculation(self):
+        # The run stops handing out work and finishes what the workers already have
+        self.hash_calculator.cancel()
+        self.cancel_btn.config(state=tk.DISABLED)
+        self.log(self._get_lang_text("LOG_CANCELLING", "Cancelling: finishing the images already being hashed"))
+
+    def resume_hash_calculation(self):
+        folder_path = self.hash_calculator.interrupted_folder()
+        if folder_path is None:
+            self.resume_btn.config(state=tk.DISABLED)
+            return
+        self._release_reference_index()
+        self.log(self._get_lang_text("LOG_RESUME_HASH_CALCULATION", "Resuming hash calculation, folder path: {0}").format(folder_path))
+        self._start_hashing(self.hash_calculator.resume)
+
     def start_check_duplicate_hashes(self):
         self.log(self._get_lang_text("LOG_START_CHECK_DUPLICATE", "Start checking duplicate hashes"))
         if not self.hash_calculator.has_existing_hashes():
@@ -187,86 +295,288 @@ class ImageDeduplicatorUI:
             self.log(self._get_lang_text("LOG_CHECK_DUPLICATE_FAILED", "Check duplicate hashes failed: Need to calculate hashes first"))
             return
         self._toggle_buttons(False)
+        self.clear_result_frame()
+        self.show_progress()
+        threading.Thread(target=self._run_duplicate_check, daemon=True).start()
+
+    def start_library_check(self):
+        image_paths = filedialog.askopenfilenames(
+            filetypes=[("Images", " ".join("*" + extension for extension in IMAGE_EXTENSIONS)), ("All files", "*.*")]
+        )
+        if not image_paths:
+            return
+        if not self.hash_calculator.has_existing_hashes():
+            messagebox.showerror(self._get_lang_text("ERROR_TITLE", "Error"), self._get_lang_text("MSG_CHECK_NEEDED", "You need to calculate the hash values first!"))
+            return
+        self.log(self._get_lang_text("LOG_START_LIBRARY_CHECK", "Checking {0} images against the library").format(len(image_paths)))
+        self._toggle_buttons(False)
         threading.Thread(
-            target=self.duplicate_analyzer.find_duplicates,
-            args=(self._on_duplicate_check_complete,),
+            target=lambda: self._on_library_check_complete(self.duplicate_analyzer.query_images(list(image_paths))),
             daemon=True
         ).start()
 
+    def _collect_match_groups(self, results):
+        # Every image with matches becomes a group led by the image itself
+        groups = []
+        image_hashes = {}
+        for result in results:
+            if result.get("matches"):
+                image_hashes[result["image"]] = result["hashes"]
+                image_hashes.update((match["path"], match["hashes"]) for match in result["matches"])
+                groups.append([result["image"]] + [match["path"] for match in result["matches"]])
+        return groups, image_hashes
+
+    def _on_library_check_complete(self, results):
+        for result in results:
+            if "error" in result:
+                self.log(self._get_lang_text("LOG_LIBRARY_QUERY_FAILED", "Could not read {0}").format(result["image"]))
+        groups, image_hashes = self._collect_match_groups(results)
+        self.log(self._get_lang_text("LOG_LIBRARY_CHECK_COMPLETE", "Library check complete: {0} of {1} images have matches").format(
+            len(groups), len(results)))
+        group_type = self._get_lang_text("GROUP_TYPE_LIBRARY_MATCH", "Library match")
+        self.events.call(lambda: [
+            self._toggle_buttons(True),
+            self.show_groups([(group_type, idx, group, image_hashes) for idx, group in enumerate(groups, 1)])
+        ])
+
+    def toggle_watch(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watch_btn.config(state=tk.DISABLED)
+            return
+        folder_path = filedialog.askdirectory()
+        if not folder_path:
+            self.log(self._get_lang_text("LOG_NO_FOLDER_SELECTED", "Oops! You haven't selected a folder yet😔."))
+            return
+        self._release_reference_index()
+        self.watcher = FolderWatcher(folder_path, self.hash_calculator, self.duplicate_analyzer, self._on_watch_batch)
+        self.watch_groups = []
+        self.watch_hashes = {}
+        # The watcher owns the hash file until it stops, so the other actions wait
+        self._toggle_buttons(False)
+        self.watch_btn.config(text=self._get_lang_text("STOP_WATCH_BTN_TEXT", "Stop watching"))
+        self.show_progress()
+        self.log(self._get_lang_text("LOG_WATCH_STARTED", "Watching {0} for new, changed and removed images").format(folder_path))
+        threading.Thread(target=self._run_watcher, daemon=True).start()
+
+    def _run_watcher(self):
+        self.watcher.run(self._update_progress)
+        self.watcher = None
+        self.events.call(lambda: [
+            self._toggle_buttons(True),
+            self._reset_progress(),
+            self.watch_btn.config(state=tk.NORMAL, text=self._get_lang_text("WATCH_BTN_TEXT", "Watch a folder for new images"))
+        ])
+        self.log(self._get_lang_text("LOG_WATCH_STOPPED", "Stopped watching"))
+
+    def _on_watch_batch(self, summary):
+        self.log(self._get_lang_text("LOG_WATCH_BATCH", "Index updated: {0} new, {1} changed, {2} moved, {3} removed; {4} new images have matches").format(
+            summary["created"], summary["modified"], summary["moved"], summary["deleted"], len(summary["matches"])))
+        if not summary["matches"]:
+            return
+        groups, image_hashes = self._collect_match_groups(summary["matches"])
+        self.watch_groups.extend(groups)
+        self.watch_hashes.update(image_hashes)
+        group_type = self._get_lang_text("GROUP_TYPE_NEW_ARRIVAL", "New Arrival Match")
+        groups = list(self.watch_groups)
+        image_hashes = dict(self.watch_hashes)
+        self.events.call(lambda: self.show_groups([(group_type, idx, group, image_hashes) for idx, group in enumerate(groups, 1)]))
+
     def _on_hash_calculation_complete(self, success):
-        self.root.after(0, lambda: [
+        if not success:
+            self.events.call(lambda: [
+                self._toggle_buttons(True),
+                self.cancel_btn.config(state=tk.DISABLED),
+                self._reset_progress()
+            ])
+            self.log(self._get_lang_text("LOG_HASH_CALCULATION_CANCELLED", "Hash calculation cancelled; finished images are kept and Resume continues from there"))
+            return
+        self.events.call(lambda: [
             self._toggle_buttons(True),
-            self.progress_bar.config(value=0),
+            self.cancel_btn.config(state=tk.DISABLED),
+            self._reset_progress(),
             messagebox.showinfo(self._get_lang_text("MSG_COMPLETE", "Completed"), self._get_lang_text("MSG_RESULTS_SAVED", "Results have been saved to {0}!").format(self.hash_calculator.result_file_path)),
             self.check_btn.config(state=tk.NORMAL),
+            self.library_btn.config(state=tk.NORMAL),
             self.start_check_duplicate_hashes()
         ])
         self.log(self._get_lang_text("LOG_HASH_CALCULATION_COMPLETE", "Hash calculation complete"))
-
-    def _on_duplicate_check_complete(self, duplicate_groups, suspicious_groups, all_image_hashes):
-        self.root.after(0, lambda: [
-            self.clear_result_frame(),
-            self._toggle_buttons(True)
+        if self.hash_stats:
+            self.log(self._get_lang_text("LOG_CACHE_STATS", "Reused {0} cached hashes, hashed {1} new or changed images").format(
+                self.hash_stats["cache_hits"], self.hash_stats["cache_misses"]))
+
+    def _on_identical_files(self, identical_groups):
+        copies = sum(len(group) - 1 for group in identical_groups)
+        self.log(self._get_lang_text("LOG_IDENTICAL_FILES", "Found {0} byte-identical copies in {1} groups; each group is decoded only once").format(
+            copies, len(identical_groups)))
+
+    def _release_reference_index(self):
+        # The reference index is memory-mapped; let go of it before a new run replaces the file
+        self.duplicate_analyzer.close()
+
+    def _run_duplicate_check(self):
+        # Groups arrive as the analyzer finalises them and are handed to the view in small batches,
+        # so the first ones show up while the rest of the library is still being compared
+        group_types = {
+            "duplicate": self._get_lang_text("GROUP_TYPE_DUPLICATE", "Default duplicate group type"),
+            "suspicious": self._get_lang_text("GROUP_TYPE_SUSPICIOUS", "Default suspicious group type")
+        }
+        counts = {"duplicate": 0, "suspicious": 0}
+        pending = []
+        last_flush = time.monotonic()
+        for group in self.duplicate_analyzer.iter_groups(self._update_progress, include_hashes=True):
+            counts[group["type"]] += 1
+            pending.append((group_types[group["type"]], counts[group["type"]], group["images"], group["hashes"]))
+            if time.monotonic() - last_flush >= RESULT_FLUSH_INTERVAL:
+                self.events.call(lambda groups=pending: self.append_groups(groups))
+                pending = []
+                last_flush = time.monotonic()
+        self.events.call(lambda: [
+            self.append_groups(pending),
+            self._toggle_buttons(True),
+            self._reset_progress()
         ])
         self.log(self._get_lang_text("LOG_CHECK_DUPLICATE_COMPLETE", "Duplicate hash check complete"))
-        if duplicate_groups or suspicious_groups:
-            self.root.after(0, lambda: self.show_duplicates(duplicate_groups, suspicious_groups, all_image_hashes))
-        else:
-            self.root.after(0, lambda: messagebox.showinfo(
+        if not any(counts.values()):
+            self.events.call(lambda: messagebox.showinfo(
                 self._get_lang_text("MSG_NO_DUPLICATES", "No duplicate or suspicious duplicate images found."),
                 self._get_lang_text("MSG_NO_DUPLICATES", "No duplicate or suspicious duplicate images found.")
             ))
 
-    def show_duplicates(self, duplicate_groups, suspicious_groups, all_image_hashes):
-        for idx, group in enumerate(duplicate_groups, 1):
-            self.create_group_frame(group, idx, self._get_lang_text("GROUP_TYPE_DUPLICATE", "Default duplicate group type"), all_image_hashes)
-        for idx, group in enumerate(suspicious_groups, 1):
-            self.create_group_frame(group, idx, self._get_lang_text("GROUP_TYPE_SUSPICIOUS", "Default suspicious group type"), all_image_hashes)
-
-    def create_group_frame(self, group, idx, group_type, all_image_hashes):
-        group_frame = ttk.LabelFrame(
-            self.result_frame,
-            text=self._get_lang_text("GROUP_LABEL", "Default group label").format(group_type, idx),
-            padding=10
-        )
-        group_frame.pack(fill=tk.X, padx=5, pady=5)
-        check_vars = {}
+    def append_groups(self, groups):
+        # Rows are added below the current ones; only the scrollregion grows until they come into view
+        self.result_groups.extend(groups)
+        self._update_scrollregion()
+        self._schedule_render()
+
+    def show_groups(self, groups):
+        # Only the groups near the viewport get widgets; the rest is just scrollregion
+        self.clear_result_frame()
+        self.result_groups = groups
+        self._update_scrollregion()
+        self.canvas.yview_moveto(0)
+        self._schedule_render()
+
+    def _update_scrollregion(self):
+        self.canvas.configure(scrollregion=(0, 0, self.content_width, len(self.result_groups) * GROUP_ROW_HEIGHT))
+
+    def _on_canvas_yview(self, first, last):
+        self.v_scrollbar.set(first, last)
+        self._schedule_render()
+
+    def _schedule_render(self):
+        if not self.render_scheduled:
+            self.render_scheduled = True
+            self.root.after_idle(self._render_visible_groups)
+
+    def _render_visible_groups(self):
+        self.render_scheduled = False
+        if not self.result_groups:
+            return
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        first = max(int(top // GROUP_ROW_HEIGHT) - RENDER_MARGIN, 0)
+        last = min(int(bottom // GROUP_ROW_HEIGHT) + RENDER_MARGIN, len(self.result_groups) - 1)
+        for index in [index for index in self.rendered_groups if not first <= index <= last]:
+            self._recycle_group(index)
+        for index in range(first, last + 1):
+            if index not in self.rendered_groups:
+                self._render_group(index)
+
+    def _render_group(self, index):
+        group_type, idx, group, all_image_hashes = self.result_groups[index]
+        # Frames that scrolled out of view are reused instead of creating new ones
+        group_frame = self.group_frame_pool.pop() if self.group_frame_pool else ttk.LabelFrame(self.canvas, padding=10)
+        group_frame.config(text=self._get_lang_text("GROUP_LABEL", "Default group label").format(group_type, idx))
+        path_labels = self.create_group_frame(group_frame, index, group, all_image_hashes)
+        item = self.canvas.create_window(5, index * GROUP_ROW_HEIGHT + 5, window=group_frame, anchor=tk.NW,
+                                         height=GROUP_ROW_HEIGHT - 10)
+        self.rendered_groups[index] = (group_frame, item, path_labels)
+        for img_path in path_labels:
+            self._show_file_info(img_path)
+            self._show_thumbnail(img_path)
+        group_frame.update_idletasks()
+        if group_frame.winfo_reqwidth() + 10 > self.content_width:
+            self.content_width = group_frame.winfo_reqwidth() + 10
+            self._update_scrollregion()
+
+    def _recycle_group(self, index):
+        group_frame, item, path_labels = self.rendered_groups.pop(index)
+        self.canvas.delete(item)
+        for widget in group_frame.winfo_children():
+            widget.destroy()
+        self.group_frame_pool.append(group_frame)
+        # Thumbnails nobody is waiting for any more are dropped if they have not started yet
+        for img_path in path_labels:
+            future = self.thumbnail_pending.get(img_path)
+            if future is not None and not self._is_rendered(img_path) and future.cancel():
+                del self.thumbnail_pending[img_path]
+
+    def _is_rendered(self, img_path):
+        return any(img_path in path_labels for _, _, path_labels in self.rendered_groups.values())
+
+    def _request_file_info(self, img_path):
+        if img_path in self.file_info or img_path in self.file_info_pending:
+            return
+        self.file_info_pending.add(img_path)
+        future = self.file_info_executor.submit(read_file_info, img_path)
+        future.add_done_callback(lambda f, path=img_path: self.events.call(self._on_file_info, path, f))
+
+    def _on_file_info(self, img_path, future):
+        self.file_info_pending.discard(img_path)
+        try:
+            self.file_info[img_path] = future.result()
+        except OSError:
+            self.file_info[img_path] = None
+        self._show_file_info(img_path)
+
+    def _show_file_info(self, img_path):
+        if img_path not in self.file_info:
+            return
+        info = self.file_info[img_path]
+        for _, _, path_labels in self.rendered_groups.values():
+            for size_label, dimensions_label, date_label, _ in path_labels.get(img_path, []):
+                if info is None:
+                    dimensions_label.config(text=self._get_lang_text("INFO_WIDTH_ERROR", "Default width and height info error message"))
+                    continue
+                file_size, file_mtime, dimensions = info
+                size_label.config(text=self._get_lang_text("FILE_SIZE", "Default file size label").format(self._format_file_size(file_size)))
+                if dimensions is None:
+                    dimensions_label.config(text=self._get_lang_text("INFO_WIDTH_ERROR", "Default width and height info error message"))
+                else:
+                    dimensions_label.config(text=self._get_lang_text("DIMENSIONS", "Default dimensions format").format(*dimensions))
+                date_label.config(text=self._get_lang_text("MODIFIED_TIME", "Default modified time label").format(time.ctime(file_mtime)))
+
+    def create_group_frame(self, group_frame, index, group, all_image_hashes):
+        check_vars = self.group_check_vars.setdefault(index, {})
+        path_labels = {}
         for col, img_path in enumerate(group):
             img_frame = ttk.Frame(group_frame)
             img_frame.grid(row=0, column=col, padx=10, pady=5)
             file_name = os.path.basename(img_path)
-            file_size = os.path.getsize(img_path)
-            size_str = self._format_file_size(file_size)
-            file_date = time.ctime(os.path.getmtime(img_path))
 
             ttk.Label(img_frame, text=self._get_lang_text("FILE_NAME", "Default file name label").format(file_name)).pack()
-            ttk.Label(img_frame, text=self._get_lang_text("FILE_SIZE", "Default file size label").format(size_str)).pack()
-
-            try:
-                with Image.open(img_path) as img:
-                    width, height = img.size
-                    dimensions_str = self._get_lang_text("DIMENSIONS", "Default dimensions format").format(width, height)
-                    ttk.Label(img_frame, text=dimensions_str).pack()
-            except Exception as e:
-                ttk.Label(img_frame, text=self._get_lang_text("INFO_WIDTH_ERROR", "Default width and height info error message")).pack()
-
-            ttk.Label(img_frame, text=self._get_lang_text("MODIFIED_TIME", "Default modified time label").format(file_date)).pack()
-
-            try:
-                thumbnail = self.get_cached_image(img_path, (150, 150))
-                label = ttk.Label(img_frame, image=thumbnail)
-                label.bind('<Button-1>', lambda e, path=img_path: self.show_large_image(path))
-                label.image = thumbnail
+            # Size, dimensions and date are filled in once a worker thread has read them
+            labels = [ttk.Label(img_frame, text="..."), ttk.Label(img_frame, text="..."), ttk.Label(img_frame, text="...")]
+            for label in labels:
                 label.pack()
-            except Exception as e:
-                ttk.Label(img_frame, text=self._get_lang_text("LOADING_ERROR", "Default image loading error message")).pack()
+            self._request_file_info(img_path)
+
+            # A blank placeholder of thumbnail size keeps the layout still until the real one arrives
+            thumbnail_label = ttk.Label(img_frame, image=self._get_placeholder_image())
+            thumbnail_label.bind('<Button-1>', lambda e, path=img_path: self.show_large_image(path))
+            thumbnail_label.pack()
+            labels.append(thumbnail_label)
+            path_labels.setdefault(img_path, []).append(labels)
+            self._request_thumbnail(img_path)
 
             hash_text = "\n".join(
                 f"{hash_type}: {all_image_hashes[img_path][hash_type]}" for hash_type in all_image_hashes[img_path]
             )
             ttk.Label(img_frame, text=hash_text).pack()
 
-            check_vars[img_path] = tk.IntVar(value=0)
+            if img_path not in check_vars:
+                check_vars[img_path] = tk.IntVar(value=0)
             cb = ttk.Checkbutton(
                 img_frame,
                 text=self._get_lang_text("BTN_DELETE_IMAGE", "Delete it"),
@@ -304,6 +614,7 @@ class ImageDeduplicatorUI:
             command=lambda vs=check_vars: self.delete_selected(vs)
         )
         delete_selected_btn.pack(side=tk.LEFT, padx=5)
+        return path_labels
 
     def delete_selected(self, check_vars):
         deleted_files = []
@@ -329,20 +640,83 @@ class ImageDeduplicatorUI:
         state = tk.NORMAL if state else tk.DISABLED
         self.select_btn.config(state=state)
         self.check_btn.config(state=state)
+        self.library_btn.config(state=state)
+        # Resume is only offered while an interrupted run is on record
+        self.resume_btn.config(state=tk.DISABLED)
+        if state == tk.NORMAL:
+            self._check_interrupted_run()
+
+    def _check_interrupted_run(self, announce=False):
+        # Looked up off the Tk thread; Resume is enabled when the answer arrives
+        threading.Thread(
+            target=lambda: self.events.call(self._on_interrupted_run, self.hash_calculator.interrupted_folder(), announce),
+            daemon=True
+        ).start()
+
+    def _on_interrupted_run(self, folder_path, announce):
+        # A run started in the meantime keeps the buttons disabled
+        if folder_path is None or str(self.select_btn.cget("state")) == tk.DISABLED:
+            return
+        self.resume_btn.config(state=tk.NORMAL)
+        if announce:
+            self.log(self._get_lang_text("LOG_RESUME_AVAILABLE", "An unfinished run of {0} can be resumed").format(folder_path))
 
     def show_progress(self):
-        self.progress_bar["value"] = 0
+        self._reset_progress()
         self.progress_bar.pack(fill=tk.X, expand=True, padx=5)
 
-    def _update_progress(self, value):
-        self.root.after(0, lambda: self.progress_bar.config(value=value))
+    def _reset_progress(self):
+        self.events.reset()
+        self.progress_bar.config(value=0)
+        self.status_label.config(text="")
+
+    def _update_progress(self, value, stats=None):
+        if stats is not None:
+            self.hash_stats = stats
+        self.events.progress(value)
+
+    def _pump_events(self):
+        frame = self.events.drain()
+        if frame is not None:
+            lines = frame["log"]
+            if frame["dropped_lines"]:
+                lines.insert(0, self._get_lang_text("LOG_LINES_SKIPPED", "... {0} log lines skipped ...").format(frame["dropped_lines"]))
+            if lines:
+                self._append_log(lines)
+            if frame["progress"] is not None:
+                self.progress_bar.config(value=frame["progress"])
+                self.status_label.config(text=self._format_status(frame))
+            for callback, args in frame["calls"]:
+                # Reported like any Tk callback error, without holding up the calls after it
+                try:
+                    callback(*args)
+                except Exception:
+                    self.root.report_callback_exception(*sys.exc_info())
+        self.root.after(int(self.events.frame_interval * 1000), self._pump_events)
+
+    def _format_status(self, frame):
+        parts = [f"{frame['progress']:.1f}%"]
+        if frame["throughput_per_s"] is not None:
+            parts.append(self._get_lang_text("STATUS_THROUGHPUT", "{0:.0f} images/s").format(frame["throughput_per_s"]))
+        if frame["eta_s"] is not None:
+            parts.append(self._get_lang_text("STATUS_ETA", "{0} left").format(format_duration(frame["eta_s"])))
+        return "  ".join(parts)
 
     def hide_progress(self):
         self.progress_bar.pack_forget()
 
     def clear_result_frame(self):
-        for widget in self.result_frame.winfo_children():
-            widget.destroy()
+        for index in list(self.rendered_groups):
+            self._recycle_group(index)
+        for group_frame in self.group_frame_pool:
+            group_frame.destroy()
+        self.group_frame_pool = []
+        self.result_groups = []
+        self.group_check_vars = {}
+        self.file_info = {}
+        self.thumbnail_failed = set()
+        self.content_width = 0
+        self._update_scrollregion()
 
     def _on_mousewheel(self, event):
         if self.canvas.winfo_containing(event.x_root, event.y_root):
@@ -358,16 +732,24 @@ class ImageDeduplicatorUI:
         self.scroll_delta = 0
 
     def log(self, message):
+        # Safe from any thread; the line is timestamped now and shown with the next frame
         current_time = time.strftime("%Y-%m-%d %H:%M:%S")
-        log_entry = f"[{current_time}] {message}\n"
-        self.log_text.insert(tk.END, log_entry)
+        self.events.log(f"[{current_time}] {message}")
+
+    def _append_log(self, lines):
+        self.log_text.insert(tk.END, "".join(line + "\n" for line in lines))
+        excess = int(self.log_text.index("end-1c").split(".")[0]) - 1 - MAX_LOG_LINES
+        if excess > 0:
+            self.log_text.delete("1.0", f"{excess + 1}.0")
         self.log_text.see(tk.END)
 
     def show_large_image(self, path):
+        # PIL's Tk bridge is only loaded once a picture is actually shown
+        from PIL import Image, ImageTk
         try:
             large_image_window = Toplevel(self.root)
             large_image_window.title(self._get_lang_text("PREVIEW_TITLE", "Default preview title").format(os.path.basename(path)))
-            with Image.open(path) as img:
+            with open_image(path) as img:
                 screen_width = large_image_window.winfo_screenwidth()
                 screen_height = large_image_window.winfo_screenheight()
                 max_width = screen_width - 20
@@ -401,10 +783,16 @@ class ImageDeduplicatorUI:
         self.root.title(self._get_lang_text("TITLE", "Default Title"))
         self.select_btn.config(text=self._get_lang_text("SELECT_BTN_TEXT", "Default select folder button text"))
         self.check_btn.config(text=self._get_lang_text("CHECK_BTN_TEXT", "Default check hashes button text"))
+        self.library_btn.config(text=self._get_lang_text("LIBRARY_BTN_TEXT", "Check new images against the library"))
+        self.cancel_btn.config(text=self._get_lang_text("CANCEL_BTN_TEXT", "Cancel hashing"))
+        self.resume_btn.config(text=self._get_lang_text("RESUME_BTN_TEXT", "Resume hashing"))
+        if self.watcher is None:
+            self.watch_btn.config(text=self._get_lang_text("WATCH_BTN_TEXT", "Watch a folder for new images"))
+        else:
+            self.watch_btn.config(text=self._get_lang_text("STOP_WATCH_BTN_TEXT", "Stop watching"))
 
     def _get_lang_text(self, key, default):
-        lang_dict = load_language(CURRENT_LANGUAGE)
-        return lang_dict.get(key, default)
+        return get_language(CURRENT_LANGUAGE).get(key, default)
 
     def _format_file_size(self, size):
         if size < 1024:
@@ -415,23 +803,68 @@ class ImageDeduplicatorUI:
             return self._get_lang_text("FILE_SIZE_MB", "Default file size in MB format").format(size / (1024 * 1024))
 
     def _update_check_button_state(self):
-        if os.path.exists("image_hashes.txt"):
+        if self.hash_calculator.has_existing_hashes():
             self.check_btn.config(state=tk.NORMAL)
+            self.library_btn.config(state=tk.NORMAL)
             self.log(self._get_lang_text("LOG_HASH_FOUND", "Default hash file found message"))
         else:
             self.log(self._get_lang_text("LOG_HASH_NOT_FOUND", "Default hash file not found message"))
+        self._check_interrupted_run(announce=True)
+
+    def _get_placeholder_image(self):
+        if self.placeholder_image is None:
+            self.placeholder_image = tk.PhotoImage(width=THUMBNAIL_SIZE[0], height=THUMBNAIL_SIZE[1])
+        return self.placeholder_image
+
+    def get_cached_image(self, path):
+        if path not in self.image_cache:
+            return None
+        self.image_cache.move_to_end(path)
+        return self.image_cache[path][0]
+
+    def _cache_image(self, path, photo):
+        size = photo.width() * photo.height() * 4
+        self.image_cache[path] = (photo, size)
+        self.image_cache_bytes += size
+        while self.image_cache_bytes > self.MAX_CACHE_BYTES and len(self.image_cache) > 1:
+            _, (_, evicted_size) = self.image_cache.popitem(last=False)
+            self.image_cache_bytes -= evicted_size
+
+    def _request_thumbnail(self, img_path):
+        if img_path in self.image_cache or img_path in self.thumbnail_pending or img_path in self.thumbnail_failed:
+            return
+        future = self.thumbnail_executor.submit(self.thumbnail_cache.get, img_path)
+        self.thumbnail_pending[img_path] = future
+        future.add_done_callback(lambda f, path=img_path: self.events.call(self._on_thumbnail, path, f))
 
-    def get_cached_image(self, path, size):
-        if path in self.image_cache:
-            self.image_cache.move_to_end(path)
-            return self.image_cache[path]
-        with Image.open(path) as img:
-            img.thumbnail(size)
-            photo = ImageTk.PhotoImage(img)
-        if len(self.image_cache) >= self.MAX_CACHE_SIZE:
-            self.image_cache.popitem(last=False)
-        self.image_cache[path] = photo
-        return photo
+    def _on_thumbnail(self, img_path, future):
+        if future.cancelled() or self.thumbnail_pending.get(img_path) is not future:
+            return
+        del self.thumbnail_pending[img_path]
+        try:
+            thumbnail = future.result()
+        except Exception:
+            self.thumbnail_failed.add(img_path)
+        else:
+            # PhotoImage has to be created on the Tk thread
+            from PIL import ImageTk
+            self._cache_image(img_path, ImageTk.PhotoImage(thumbnail))
+        self._show_thumbnail(img_path)
+
+    def _show_thumbnail(self, img_path):
+        photo = self.get_cached_image(img_path)
+        failed = img_path in self.thumbnail_failed
+        if photo is None and not failed:
+            return
+        for _, _, path_labels in self.rendered_groups.values():
+            for labels in path_labels.get(img_path, []):
+                thumbnail_label = labels[-1]
+                if failed:
+                    thumbnail_label.config(image="", text=self._get_lang_text("LOADING_ERROR", "Default image loading error message"))
+                else:
+                    # The label keeps its own reference, so eviction from the cache cannot blank it
+                    thumbnail_label.config(image=photo)
+                    thumbnail_label.image = photo
 
     def select_all_in_group(self, check_vars):
         for var in check_vars.values():
@@ -0,0 +1,424 @@
+import heapq
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+import numpy as np
+from calculation import generate_hashes_batch
+from hash_cache import file_signature
+from hash_index import hamming_distance, tier_matches
+from hash_store import HashStore, HashStoreWriter, hash_to_int
+from scanner import walk_directories
+
+# Seconds between folder scans, quiet time before collected changes are applied, and the
+# longest changes wait while a bulk copy keeps the folder busy
+DEFAULT_POLL_INTERVAL = 2.0
+DEFAULT_DEBOUNCE = 3.0
+DEFAULT_MAX_BATCH_DELAY = 30.0
+# Seconds between full rescans; the scans in between only relist directories whose mtime moved
+DEFAULT_FULL_SCAN_INTERVAL = 60.0
+# Seconds between folding applied changes into the hash file, and the share of the hash file
+# they may reach before they are folded in early
+DEFAULT_MERGE_INTERVAL = 300.0
+MERGE_FRACTION = 0.05
+
+def _file_changed(old, new):
+
+    return (old.st_size, old.st_mtime_ns, old.st_ino) != (new.st_size, new.st_mtime_ns, new.st_ino)
+
+# The image files under a folder with their stat results, kept per directory so a scan can skip
+# directories that did not change. Creating, deleting or renaming a file moves its directory's
+# mtime; a file rewritten in place does not, and is picked up by the next full scan.
+class FolderSnapshot:
+    def __init__(self, folder_path):
+
+        self.folder_path = folder_path
+        self.files = {}
+        # directory -> (mtime_ns, image paths, subdirectories) as of its last listing
+        self.directories = {}
+
+    def scan(self, full=False):
+
+        # Returns the image paths created, changed or removed since the previous scan
+        if full or not self.directories:
+            return self._full_scan()
+        stale = []
+        for directory, (mtime, _, _) in self.directories.items():
+            try:
+                current = os.stat(directory).st_mtime_ns
+            except OSError:
+                current = None
+            if current != mtime:
+                stale.append(directory)
+        changed = set()
+        added = []
+        for directory, mtime, files, subdirectories in walk_directories(stale, recurse=False):
+            if directory not in self.directories:
+                # Already dropped along with a removed parent
+                continue
+            if mtime is None:
+                self._drop(directory, changed)
+                continue
+            _, old_paths, old_subdirectories = self.directories[directory]
+            files = dict(files)
+            for image_path in old_paths:
+                if image_path not in files:
+                    del self.files[image_path]
+                    changed.add(image_path)
+            for image_path, stat_result in files.items():
+                if image_path not in self.files or _file_changed(self.files[image_path], stat_result):
+                    self.files[image_path] = stat_result
+                    changed.add(image_path)
+            for subdirectory in old_subdirectories:
+                if subdirectory not in subdirectories:
+                    self._drop(subdirectory, changed)
+            added.extend(subdirectory for subdirectory in subdirectories if subdirectory not in old_subdirectories)
+            self.directories[directory] = (mtime, list(files), subdirectories)
+        for directory, mtime, files, subdirectories in walk_directories(added):
+            if mtime is not None:
+                self._add(directory, mtime, files, subdirectories)
+                changed.update(image_path for image_path, _ in files)
+        return changed
+
+    def _full_scan(self):
+
+        previous = self.files
+        self.files = {}
+        self.directories = {}
+        for directory, mtime, files, subdirectories in walk_directories([self.folder_path]):
+            if mtime is not None:
+                self._add(directory, mtime, files, subdirectories)
+        changed = {image_path for image_path, stat_result in self.files.items()
+                   if image_path not in previous or _file_changed(previous[image_path], stat_result)}
+        changed.update(image_path for image_path in previous if image_path not in self.files)
+        return changed
+
+    def _add(self, directory, mtime, files, subdirectories):
+
+        self.directories[directory] = (mtime, [image_path for image_path, _ in files], subdirectories)
+        self.files.update(files)
+
+    def _drop(self, directory, changed):
+
+        entry = self.directories.pop(directory, None)
+        if entry is None:
+            return
+        for image_path in entry[1]:
+            self.files.pop(image_path, None)
+            changed.add(image_path)
+        for subdirectory in entry[2]:
+            self._drop(subdirectory, changed)
+
+# Changes applied since the hash file was last rewritten. Between merges the hash file and its
+# reference index stay as they are; `removed` hides their records of changed or deleted files
+# and `added` holds the current hashes of changed files, which queries check directly.
+class StoreOverlay:
+    def __init__(self, hash_types, hash_tiers):
+
+        self.hash_types = hash_types
+        tiers = [[hash_types.index(hash_type) for hash_type in tier if hash_type in hash_types] for tier in hash_tiers]
+        self.tiers = [tier for tier in tiers if tier]
+        self.added = {}
+        self.removed = set()
+        self.arrays = None
+
+    def __len__(self):
+
+        return len(self.removed)
+
+    def put(self, image_path, hashes):
+
+        # hashes is None for a file that could not be decoded; it simply leaves the store
+        self.removed.add(image_path)
+        if hashes is None:
+            self.added.pop(image_path, None)
+        else:
+            self.added[image_path] = hashes
+        self.arrays = None
+
+    def remove(self, image_path):
+
+        self.removed.add(image_path)
+        self.added.pop(image_path, None)
+        self.arrays = None
+
+    def _build_arrays(self):
+
+        # Rebuilt at most once per batch, on the first query after it was applied
+        paths = list(self.added)
+        matrix = np.zeros((len(paths), len(self.hash_types)), dtype=np.uint64)
+        present = np.zeros((len(paths), len(self.hash_types)), dtype=bool)
+        for row, image_path in enumerate(paths):
+            for t, hash_type in enumerate(self.hash_types):
+                if hash_type in self.added[image_path]:
+                    matrix[row, t] = hash_to_int(self.added[image_path][hash_type])
+                    present[row, t] = True
+        self.arrays = paths, matrix, present
+
+    def query(self, hashes, thresholds):
+
+        # Same result format as ReferenceIndex.query
+        if not self.added:
+            return []
+        if self.arrays is None:
+            self._build_arrays()
+        paths, matrix, present = self.arrays
+        values = np.array([hash_to_int(hashes[hash_type]) if hash_type in hashes else 0 for hash_type in self.hash_types],
+                          dtype=np.uint64)
+        distances = hamming_distance(matrix, values)
+        comparable = present & np.array([hash_type in hashes for hash_type in self.hash_types])
+        limits = np.array([thresholds.get(hash_type, 0) for hash_type in self.hash_types])
+        matches = []
+        for row in np.flatnonzero(tier_matches(distances, comparable, limits, self.tiers)).tolist():
+            match_distances = {hash_type: int(distances[row, t]) for t, hash_type in enumerate(self.hash_types)
+                               if comparable[row, t]}
+            matches.append({
+                "path": paths[row],
+                "hashes": self.added[paths[row]],
+                "distances": match_distances,
+                "duplicate": not any(match_distances.values())
+            })
+        return matches
+
+# Keeps the hash store of one folder live. The folder is polled rather than watched through
+# inotify, so the same code runs on every platform; changes are collected until the folder has
+# been quiet for `debounce` seconds and then applied together. A batch only touches the changed
+# files: their hashes go to an in-memory overlay and the cache journal, and the hash file is
+# rewritten once per merge interval or when the watcher stops.
+class FolderWatcher:
+    def __init__(self, folder_path, calculator, analyzer, batch_callback=None, interval=DEFAULT_POLL_INTERVAL,
+                 debounce=DEFAULT_DEBOUNCE, max_batch_delay=DEFAULT_MAX_BATCH_DELAY,
+                 full_scan_interval=DEFAULT_FULL_SCAN_INTERVAL, merge_interval=DEFAULT_MERGE_INTERVAL):
+
+        if calculator.shard_count > 1:
+            raise ValueError("Watch mode needs an unsharded hash file")
+        self.folder_path = folder_path
+        self.calculator = calculator
+        # Answers the new-arrival queries; must read the hash file the calculator writes
+        self.analyzer = analyzer
+        self.batch_callback = batch_callback
+        self.interval = interval
+        self.debounce = debounce
+        self.max_batch_delay = max_batch_delay
+        self.full_scan_interval = full_scan_interval
+        self.merge_interval = merge_interval
+        self.snapshot = FolderSnapshot(folder_path)
+        self.overlay = None
+        self.store_count = 0
+        self.changed = set()
+        self.first_change = None
+        self.last_change = None
+        self.last_full_scan = None
+        self.last_merge = None
+        self.stop_event = threading.Event()
+
+    def run(self, progress_callback=None):
+
+        # Blocks until stop(). The first snapshot is taken before the catch-up run, so a file that
+        # changes while that run is hashing shows up in the first batch instead of being missed.
+        self.snapshot.scan(full=True)
+        self.last_full_scan = time.monotonic()
+        if self.stop_event.is_set():
+            return
+        self.calculator.calculate_hashes(self.folder_path, progress_callback or (lambda value, stats=None: None),
+                                         lambda success: None)
+        if self.calculator.cancelled():
+            # Stopped during the catch-up run; its journal lets the next run resume it
+            return
+        self._open_overlay()
+        cache = self.calculator.cache
+        cache.start_journal(self._run_info())
+        try:
+            with self.calculator.create_executor() as executor:
+                while not self.stop_event.wait(self.interval):
+                    self.poll()
+                    try:
+                        if self.ready():
+                            changed = self.take_batch()
+                            try:
+                                self.apply(executor, changed)
+                            except OSError:
+                                self.add_changes(changed)
+                                raise
+                        if self.merge_due():
+                            self.merge()
+                            cache.start_journal(self._run_info())
+                    except OSError as e:
+                        # e.g. the hash file is held open by another reader; retried with the next batch
+                        print(f"Could not update {self.calculator.result_file_path}: {e}", file=sys.stderr)
+        finally:
+            # Also on Ctrl+C, so applied batches reach the hash file. Changes still waiting are not
+            # lost: the next catch-up run finds them through the cache
+            self.merge()
+
+    def stop(self):
+
+        # Also interrupts a catch-up run that is still hashing
+        self.stop_event.set()
+        self.calculator.cancel()
+
+    def _run_info(self):
+
+        return {"folder": self.folder_path, "hashes": self.calculator.result_file_path}
+
+    def _open_overlay(self):
+
+        with HashStore(self.calculator.result_file_path) as store:
+            self.overlay = StoreOverlay(store.hash_types, store.hash_tiers)
+            self.store_count = len(store)
+        self.last_merge = time.monotonic()
+
+    def poll(self):
+
+        now = time.monotonic()
+        full = now - self.last_full_scan >= self.full_scan_interval
+        if full:
+            self.last_full_scan = now
+        changed = self.snapshot.scan(full)
+        if changed:
+            self.add_changes(changed)
+
+    def add_changes(self, changed):
+
+        now = time.monotonic()
+        if self.first_change is None:
+            self.first_change = now
+        self.last_change = now
+        self.changed |= changed
+
+    def ready(self):
+
+        if not self.changed:
+            return False
+        now = time.monotonic()
+        return now - self.last_change >= self.debounce or now - self.first_change >= self.max_batch_delay
+
+    def take_batch(self):
+
+        changed, self.changed = self.changed, set()
+        self.first_change = self.last_change = None
+        return changed
+
+    def merge_due(self):
+
+        return len(self.overlay) > 0 and (time.monotonic() - self.last_merge >= self.merge_interval
+                                          or len(self.overlay) >= MERGE_FRACTION * max(self.store_count, 1))
+
+    def merge(self):
+
+        # Folds the overlay into the hash file in one sequential rewrite and compacts the cache;
+        # the reference index is rebuilt by the first query after that
+        cache = self.calculator.cache
+        if len(self.overlay):
+            store_path = self.calculator.result_file_path
+            next_path = store_path + ".next"
+            self.analyzer.close()
+            with HashStore(store_path) as store:
+                records = ((store.path(i), i) for i in range(len(store)))
+                with HashStoreWriter(next_path, store.hash_types, store.metadata) as writer:
+                    # Both sides are in path order, so the merged file is too
+                    for image_path, source in heapq.merge(records, sorted(self.overlay.added.items()),
+                                                          key=lambda record: record[0]):
+                        if not isinstance(source, int):
+                            writer.write(image_path, source)
+                        elif image_path not in self.overlay.removed:
+                            writer.write(image_path, store.hashes(source))
+                    self.store_count = writer.count
+            os.replace(next_path, store_path)
+            self.overlay = StoreOverlay(self.overlay.hash_types, store.hash_tiers)
+        cache.save()
+        self.last_merge = time.monotonic()
+
+    def query(self, hashes):
+
+        # Library records the overlay replaced or deleted are hidden; the overlay answers for them
+        matches = [match for match in self.analyzer.query(hashes) if match["path"] not in self.overlay.removed]
+        matches.extend(self.overlay.query(hashes, self.analyzer.thresholds))
+        matches.sort(key=lambda match: sum(match["distances"].values()))
+        return matches
+
+    def apply(self, executor, changed):
+
+        start = time.perf_counter()
+        cache = self.calculator.cache
+        # Whatever exists now is (re)hashed, everything else was deleted; a file that was created
+        # and removed again within one batch simply never reaches the store
+        present = {image_path: self.snapshot.files[image_path] for image_path in changed if image_path in self.snapshot.files}
+        deleted = changed - present.keys()
+        stored = {image_path for image_path in changed if cache.entries.get(image_path, (None, None))[1] is not None}
+        # A deleted file whose signature turns up under a new path was moved or renamed; one that
+        # failed to decode is hashed again under its new path
+        moved_from = {cache.entries[image_path][0]: image_path for image_path in deleted & stored}
+
+        hash_types = self.overlay.hash_types
+        results = {}
+        moved = set()
+        moved_sources = set()
+        todo = []
+        for image_path, stat_result in sorted(present.items()):
+            signature = file_signature(stat_result, cache.use_inode)
+            hit, hashes = cache.lookup(image_path, signature)
+            if hit and (hashes is None or all(hash_type in hashes for hash_type in hash_types)):
+                results[image_path] = hashes
+            elif signature in moved_from:
+                source = moved_from.pop(signature)
+                results[image_path] = cache.entries[source][1]
+                moved.add(image_path)
+                moved_sources.add(source)
+            else:
+                todo.append(image_path)
+        chunk_size = self.calculator.chunk_size
+        batches = deque(todo[offset:offset + chunk_size] for offset in range(0, len(todo), chunk_size))
+        pending = {}
+        # The same bounded window as a hashing run; after Stop no further batch goes out
+        while batches or pending:
+            while batches and len(pending) < self.calculator.max_in_flight and not self.calculator.cancelled():
+                batch = batches.popleft()
+                pending[executor.submit(generate_hashes_batch, batch, hash_types)] = batch
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = pending.pop(future)
+                batch_results, _ = future.result()
+                for image_path, result in zip(batch, batch_results):
+                    results[image_path] = result[1] if result else None
+        # Files Stop left unhashed are not applied; the next catch-up run finds them
+        skipped = {image_path for batch in batches for image_path in batch}
+        for image_path in skipped:
+            del present[image_path]
+        if skipped:
+            self.add_changes(skipped)
+
+        for image_path in deleted:
+            cache.discard(image_path)
+            self.overlay.remove(image_path)
+        for image_path, hashes in results.items():
+            cache.update(image_path, file_signature(present[image_path], cache.use_inode), hashes)
+            self.overlay.put(image_path, hashes)
+        # Only the changed entries are written: appended to the cache journal and made durable
+        cache.checkpoint()
+
+        # New and changed images are checked against the library and the overlay, so copies that
+        # arrive together in one batch find each other as well
+        matches = []
+        for image_path, hashes in sorted(results.items()):
+            if hashes is None or image_path in moved:
+                continue
+            found = [match for match in self.query(hashes) if match["path"] != image_path]
+            if found:
+                matches.append({"image": image_path, "hashes": hashes, "matches": found})
+        summary = {
+            "created": len(present.keys() - stored - moved),
+            "modified": len((present.keys() & stored) - moved),
+            "moved": len(moved),
+            "deleted": len((deleted & stored) - moved_sources),
+            "failed": sum(1 for hashes in results.values() if hashes is None),
+            "matches": matches,
+            "elapsed_s": time.perf_counter() - start,
+        }
+        if self.batch_callback is not None:
+            self.batch_callback(summary)
+        return summary